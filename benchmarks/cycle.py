@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# Measure a whole Plimni run against synthetic clusters, phase by phase:
+# - `discovery`: retrieving the services from the (fake) orchestrator,
+# - `services`: building the `Service` objects from the annotations / tags,
+# - `render`: rendering the configurations (`Configuration`),
+# - `detect`: knowing which files changed,
+# - `write`: writing the changed files.
+#
+# For each number of services, 3 runs are timed one after the other, with the
+# same caches as the daemon:
+# - `cold`: the first run (nothing is cached, every file is written),
+# - `unchanged`: same services as the previous run,
+# - `changed`: `--changes` services got a new backend since the previous run.
+#
+# The peak memory of a cold run is measured separately (tracemalloc slows
+# everything down). The results are printed as JSON (or written to
+# `--output`) along with the commit they were measured on, so they can be
+# compared between commits.
+#
+# Usage:
+#   python3 benchmarks/cycle.py --services 5000 20000 50000 --output out.json
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from kubernetes import client
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import plimni.cache  # noqa: E402
+import plimni.clients  # noqa: E402
+import plimni.configuration  # noqa: E402
+import plimni.k8s  # noqa: E402
+import plimni.nomad  # noqa: E402
+import plimni.runtime  # noqa: E402
+from plimni.tags import Tags  # noqa: E402
+
+CLUSTER_BRANCH = "master"
+CLUSTER_DOMAIN = "example.com"
+
+
+class SyntheticCluster():
+    """
+    The Plimni settings and the backends of `services` services, all
+    exposed. Every `sanitize_every` service sanitizes 2 codes and every
+    service has `additional_fqdns` additional FQDNs.
+    """
+    def __init__(self, services: int, backends: int, sanitize_every: int,
+                 additional_fqdns: int):
+        self.services = []
+
+        for i in range(services):
+            settings = {Tags.EXPOSE: "true"}
+
+            if additional_fqdns:
+                settings[Tags.ADDITIONAL_FQDNS] = ",".join(
+                    "alias-{}-{}.example.org".format(j, i)
+                    for j in range(additional_fqdns)
+                )
+
+            if sanitize_every and i % sanitize_every == 0:
+                settings[Tags.HTTP_SANITIZE_CODES] = "500,502"
+                settings[Tags.HTTP_SANITIZE_RETURN] = "204"
+
+            self.services.append((
+                "svc-{}".format(i),
+                settings,
+                [
+                    ("10.{}.{}.{}".format(i // 256 % 256, i % 256, j), 8080)
+                    for j in range(backends)
+                ],
+            ))
+
+        self._changes = 0
+
+    def change(self, count: int):
+        """Add a backend to `count` services spread over the cluster."""
+        step = max(len(self.services) // max(count, 1), 1)
+
+        for i in range(0, step * count, step):
+            name, settings, backends = self.services[i % len(self.services)]
+            self._changes += 1
+            backends = backends + [
+                ("10.255.{}.{}".format(self._changes // 256 % 256,
+                                       self._changes % 256), 8080),
+            ]
+            self.services[i % len(self.services)] = name, settings, backends
+
+
+class FakeNomadClient(plimni.clients.Client):
+    """Return the cluster services as Consul would."""
+    def __init__(self, cluster: SyntheticCluster):
+        super().__init__()
+        self.cluster = cluster
+
+    def discover(self) -> dict:
+        return {
+            name: (
+                ["{}={}".format(key, value)
+                 for key, value in settings.items()],
+                [{"Address": ip, "ServicePort": port}
+                 for ip, port in backends],
+            )
+            for name, settings, backends in self.cluster.services
+        }
+
+    def build(self, discovered: dict) -> list:
+        services = [
+            self._factory.build(
+                name=name,
+                settings=plimni.nomad.NomadClient._settings(tags),
+                backends=plimni.nomad.NomadClient._backends(endpoints),
+                cluster_branch=CLUSTER_BRANCH,
+                cluster_domain=CLUSTER_DOMAIN,
+            )
+            for name, (tags, endpoints) in discovered.items()
+        ]
+        self._factory.rotate()
+        return services
+
+    def get_services(self, cluster_branch: str, cluster_domain: str):
+        return self.build(self.discover())
+
+    def get_certbot_url(self, private_ip: str) -> str:
+        return "{}:8080".format(private_ip)
+
+
+class FakeKubernetesClient(plimni.clients.Client):
+    """Return the cluster services as the Kubernetes API server would."""
+    def __init__(self, cluster: SyntheticCluster):
+        super().__init__()
+        self.cluster = cluster
+
+    def discover(self) -> dict:
+        return {
+            name: (
+                client.V1Service(metadata=client.V1ObjectMeta(
+                    name=name,
+                    annotations=settings,
+                )),
+                client.V1Endpoints(
+                    metadata=client.V1ObjectMeta(name=name),
+                    subsets=[client.V1EndpointSubset(
+                        addresses=[client.V1EndpointAddress(ip=ip)
+                                   for ip, _ in backends],
+                        ports=[client.CoreV1EndpointPort(port=8080)],
+                    )],
+                ),
+            )
+            for name, settings, backends in self.cluster.services
+        }
+
+    def build(self, discovered: dict) -> list:
+        services = [
+            self._factory.build(
+                name=name,
+                settings=service.metadata.annotations,
+                backends=plimni.k8s.KubernetesClient._backends([endpoint]),
+                cluster_branch=CLUSTER_BRANCH,
+                cluster_domain=CLUSTER_DOMAIN,
+            )
+            for name, (service, endpoint) in discovered.items()
+        ]
+        self._factory.rotate()
+        return services
+
+    def get_services(self, cluster_branch: str, cluster_domain: str):
+        return self.build(self.discover())
+
+    def get_certbot_url(self, private_ip: str) -> str:
+        return "certbot.plimni.svc.cluster.local"
+
+
+CLIENTS = {
+    "k8s": FakeKubernetesClient,
+    "nomad": FakeNomadClient,
+}
+
+
+class Daemon():
+    """What the Plimni daemon keeps from one run to the next."""
+    def __init__(self, folder: str, fake_client: plimni.clients.Client,
+                 runtime_api: bool):
+        self.folder = folder
+        self.client = fake_client
+        self.fragment_cache = plimni.cache.FragmentCache()
+        self.digest_cache = plimni.cache.DigestCache()
+        self.server_slots = (
+            plimni.runtime.ServerSlots() if runtime_api else None
+        )
+
+    def run(self) -> dict:
+        """Run Plimni once and return how long each phase took."""
+        timings = {}
+        start = time.perf_counter()
+
+        def lap(phase: str):
+            nonlocal start
+            now = time.perf_counter()
+            timings[phase] = round(now - start, 4)
+            start = now
+
+        discovered = self.client.discover()
+        lap("discovery")
+
+        services = self.client.build(discovered)
+        lap("services")
+
+        configuration = plimni.configuration.Configuration(
+            haproxy_services_conf_file=os.path.join(self.folder,
+                                                    "services.cfg"),
+            haproxy_hosts_map_file=os.path.join(self.folder, "hosts.map"),
+            haproxy_server_state_file=os.path.join(self.folder,
+                                                   "server-state"),
+            haproxy_crt_list_file=os.path.join(self.folder, "crt-list"),
+            haproxy_sanitize_conf_folder=self.folder,
+            certbot_conf_folder=self.folder,
+            cluster_domain=CLUSTER_DOMAIN,
+            cluster_email=None,
+            cluster_branch=CLUSTER_BRANCH,
+            services=services,
+            certbot_url=self.client.get_certbot_url("127.0.0.1"),
+            fragment_cache=self.fragment_cache,
+            digest_cache=self.digest_cache,
+            server_slots=self.server_slots,
+        )
+        lap("render")
+
+        changed = {
+            "haproxy": configuration.haproxy_changed(),
+            "hosts_map": configuration.hosts_map_changed(),
+            "crt_list": configuration.crt_list_changed(),
+            "sanitize": configuration.sanitize_changed(),
+            "certbot": configuration.certbot_changed(),
+        }
+        lap("detect")
+
+        for name, has_changed in changed.items():
+            if has_changed:
+                getattr(configuration, name + "_write")()
+        lap("write")
+
+        if self.server_slots is not None:
+            self.server_slots.pop_changes()
+
+        timings["total"] = round(sum(timings.values()), 4)
+        timings["written"] = sorted(
+            name for name, has_changed in changed.items() if has_changed
+        )
+
+        return timings
+
+
+def measure(args, count: int) -> dict:
+    result = {"services": count}
+
+    cluster = SyntheticCluster(
+        services=count,
+        backends=args.backends,
+        sanitize_every=args.sanitize_every,
+        additional_fqdns=args.additional_fqdns,
+    )
+
+    with tempfile.TemporaryDirectory() as folder:
+        daemon = Daemon(folder, CLIENTS[args.orchestrator](cluster),
+                        args.runtime_api)
+
+        result["cold"] = daemon.run()
+        result["unchanged"] = daemon.run()
+        cluster.change(args.changes)
+        result["changed"] = daemon.run()
+
+    with tempfile.TemporaryDirectory() as folder:
+        daemon = Daemon(folder, CLIENTS[args.orchestrator](cluster),
+                        args.runtime_api)
+
+        tracemalloc.start()
+        daemon.run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        result["peak_memory_mb"] = round(peak / 1024 / 1024, 1)
+
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser("cycle")
+    parser.add_argument("--orchestrator", choices=sorted(CLIENTS),
+                        default="k8s")
+    parser.add_argument("--services", type=int, nargs="+",
+                        default=[5000, 20000, 50000])
+    parser.add_argument("--backends", type=int, default=3)
+    parser.add_argument("--sanitize-every", type=int, default=10,
+                        help="Every how many services sanitize codes (0 for "
+                             "none)")
+    parser.add_argument("--additional-fqdns", type=int, default=1,
+                        help="How many additional FQDNs each service has")
+    parser.add_argument("--changes", type=int, default=1,
+                        help="How many services change for the `changed` run")
+    parser.add_argument("--runtime-api", action="store_true",
+                        help="Render servers slots, as with "
+                             "--haproxy-runtime-api")
+    parser.add_argument("--output",
+                        help="Write the results to this file instead of "
+                             "printing them")
+    args = parser.parse_args()
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "parameters": {
+            key: value for key, value in vars(args).items()
+            if key != "output"
+        },
+        "results": [],
+    }
+
+    for count in args.services:
+        results["results"].append(measure(args, count))
+
+    output = json.dumps(results, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as file_:
+            file_.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
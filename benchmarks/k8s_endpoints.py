@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Compare the time needed to retrieve the services and their endpoints from a
+# Kubernetes API server when the endpoints are read one service at a time (the
+# former behaviour) and when they are listed at once.
+#
+# A fake API server is started locally; it adds `--latency` milliseconds to
+# every request to simulate the network round-trip to a real API server.
+#
+# Usage:
+#   python3 benchmarks/k8s_endpoints.py --services 2000 --latency 2
+
+import argparse
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+from kubernetes import client
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import plimni.k8s  # noqa: E402
+
+
+class FakeApiServer(http.server.ThreadingHTTPServer):
+    def __init__(self, services: int, backends: int, latency: float):
+        super().__init__(("127.0.0.1", 0), FakeApiHandler)
+        self.latency = latency
+        self.requests = 0
+        self.services = [
+            {
+                "metadata": {
+                    "name": "svc-{}".format(i),
+                    "namespace": "default",
+                    "annotations": {"plimni.io/expose": "true"},
+                },
+            }
+            for i in range(services)
+        ]
+        self.endpoints = [
+            {
+                "metadata": {"name": "svc-{}".format(i),
+                             "namespace": "default"},
+                "subsets": [{
+                    "addresses": [
+                        {"ip": "10.{}.{}.{}".format(i // 256 % 256, i % 256, j)}
+                        for j in range(backends)
+                    ],
+                    "ports": [{"port": 8080}],
+                }],
+            }
+            for i in range(services)
+        ]
+
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    PREFIX = "/api/v1/namespaces/default/"
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        kind, _, name = url.path[len(FakeApiHandler.PREFIX):].partition("/")
+        items = getattr(self.server, kind)
+
+        if name:
+            body = next(i for i in items if i["metadata"]["name"] == name)
+        else:
+            start = int(query.get("continue", ["0"])[0])
+            limit = int(query.get("limit", [len(items)])[0])
+            end = start + limit
+            body = {
+                "metadata": {
+                    "resourceVersion": "1",
+                    "continue": str(end) if end < len(items) else None,
+                },
+                "items": items[start:end],
+            }
+
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def read_one_by_one(api: client.CoreV1Api):
+    services = api.list_namespaced_service(namespace="default")
+
+    for service in services.items:
+        api.read_namespaced_endpoints(
+            name=service.metadata.name,
+            namespace="default",
+        )
+
+
+def list_at_once(api: client.CoreV1Api):
+    plimni.k8s.KubernetesClient(api).get_services(
+        cluster_branch="master",
+        cluster_domain="example.com",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("k8s_endpoints")
+    parser.add_argument("--services", type=int, default=1000)
+    parser.add_argument("--backends", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=1,
+                        help="Added latency per request, in milliseconds")
+    args = parser.parse_args()
+
+    server = FakeApiServer(args.services, args.backends, args.latency / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    configuration = client.Configuration()
+    configuration.host = "http://127.0.0.1:{}".format(server.server_port)
+    api = client.CoreV1Api(client.ApiClient(configuration))
+
+    results = {"services": args.services, "latency_ms": args.latency}
+
+    for name, func in (("read_one_by_one", read_one_by_one),
+                       ("list_at_once", list_at_once)):
+        server.requests = 0
+        start = time.perf_counter()
+        func(api)
+        results[name] = {
+            "seconds": round(time.perf_counter() - start, 3),
+            "requests": server.requests,
+        }
+
+    print(json.dumps(results, indent=2))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Measure how long it takes to render the HAProxy configuration depending on
+# the number of services, with and without the fragment cache.
+#
+# For each number of services, 3 timings are reported:
+# - `cold`: nothing is cached (this is also the cost without a cache),
+# - `unchanged`: same services as the previous run,
+# - `one_changed`: a single service got a new backend since the previous run.
+#
+# Usage:
+#   python3 benchmarks/render.py --services 1000 5000 20000
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import plimni.cache  # noqa: E402
+import plimni.configuration  # noqa: E402
+import plimni.services  # noqa: E402
+
+
+def make_services(count: int, backends: int, changed: int = None) -> list:
+    services = []
+
+    for i in range(count):
+        svc_backends = [
+            ("10.{}.{}.{}".format(i // 256 % 256, i % 256, j), 8080)
+            for j in range(backends)
+        ]
+
+        if i == changed:
+            svc_backends.append(("10.255.255.255", 8080))
+
+        services.append(plimni.services.Service(
+            cluster_branch="master",
+            cluster_domain="example.com",
+            expose="true",
+            name="svc-{}".format(i),
+            branch=None,
+            fqdn=None,
+            additional_fqdns=None,
+            mode=None,
+            http_port=None,
+            https_port=None,
+            http_sanitize_codes=["500", "502"] if i % 10 == 0 else None,
+            http_sanitize_return="204" if i % 10 == 0 else None,
+            backends=svc_backends,
+        ))
+
+    return services
+
+
+def render(folder: str, services: list,
+           fragment_cache: plimni.cache.FragmentCache) -> float:
+    start = time.perf_counter()
+    plimni.configuration.Configuration(
+        haproxy_services_conf_file=os.path.join(folder, "services.cfg"),
+        haproxy_hosts_map_file=os.path.join(folder, "hosts.map"),
+        haproxy_server_state_file=os.path.join(folder, "server-state"),
+        haproxy_crt_list_file=os.path.join(folder, "crt-list"),
+        haproxy_sanitize_conf_folder=folder,
+        certbot_conf_folder=folder,
+        cluster_domain="example.com",
+        cluster_email=None,
+        cluster_branch="master",
+        services=services,
+        certbot_url="certbot",
+        fragment_cache=fragment_cache,
+    )
+    return round(time.perf_counter() - start, 4)
+
+
+def main():
+    parser = argparse.ArgumentParser("render")
+    parser.add_argument("--services", type=int, nargs="+",
+                        default=[1000, 5000, 20000])
+    parser.add_argument("--backends", type=int, default=3)
+    args = parser.parse_args()
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as folder:
+        for count in args.services:
+            services = make_services(count, args.backends)
+            changed = make_services(count, args.backends, changed=count // 2)
+
+            fragment_cache = plimni.cache.FragmentCache()
+
+            results.append({
+                "services": count,
+                "cold": render(folder, services, fragment_cache),
+                "unchanged": render(folder, services, fragment_cache),
+                "one_changed": render(folder, changed, fragment_cache),
+            })
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
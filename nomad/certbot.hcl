@@ -21,7 +21,9 @@ job "plimni-certbot" {
 
 			config {
 				image = "certbot/certbot:v0.31.0"
-				args = ["certonly", "-c", "/etc/letsencrypt/cli.ini"]
+				# One configuration per certificate shard; a failing shard does not prevent the others from being renewed
+				entrypoint = ["sh", "-c"]
+				args = ["status=0; for config in /etc/letsencrypt/cli*.ini; do certbot certonly -c \"$config\" || status=1; done; exit $status"]
 				volumes = [
 					"/volumes/certs/:/etc/letsencrypt/",
 				]
@@ -15,8 +15,8 @@ job "plimni" {
 			driver = "docker"
 
 			config {
-				image = "haproxy:2.0.6"
-				args = ["bash", "-c", "touch ${HAP_SRV_CONF} && haproxy -f ${NOMAD_TASK_DIR}/haproxy.cfg -f ${HAP_SRV_CONF}"]
+				image = "haproxy:2.2"
+				args = ["bash", "-c", "touch ${HAP_GLOBAL_CONF} ${HAP_SRV_CONF} && haproxy -f ${NOMAD_TASK_DIR}/haproxy.cfg -f ${HAP_GLOBAL_CONF} -f ${HAP_SRV_CONF}"]
 				network_mode = "host"
 				pid_mode = "host"
 
@@ -31,6 +31,7 @@ job "plimni" {
 			}
 
 			env {
+				HAP_GLOBAL_CONF = "${NOMAD_ALLOC_DIR}/data/haproxy-global.cfg"
 				HAP_SRV_CONF = "${NOMAD_ALLOC_DIR}/data/haproxy-services.cfg"
 			}
 
@@ -43,16 +44,9 @@ global
 	log stderr format rfc5424 local0 info
 	master-worker
 	pidfile {{ env "NOMAD_ALLOC_DIR" }}/data/haproxy.pid
-	maxconn 50000
-	nbthread 2
 	stats socket {{ env "NOMAD_ALLOC_DIR" }}/data/stats.sock mode 666 level admin
-	# Enforce strong algorithms
-	ssl-default-bind-ciphers ECDHE-ECDSA-AES256-GCM-SHA384:ECDHE-RSA-AES256-GCM-SHA384:ECDHE-ECDSA-CHACHA20-POLY1305:ECDHE-RSA-CHACHA20-POLY1305:ECDHE-ECDSA-AES128-GCM-SHA256:ECDHE-RSA-AES128-GCM-SHA256:ECDHE-ECDSA-AES256-SHA384:ECDHE-RSA-AES256-SHA384:ECDHE-ECDSA-AES128-SHA256:ECDHE-RSA-AES128-SHA256
-	ssl-default-bind-options no-sslv3 no-tlsv10 no-tlsv11 no-tls-tickets
-	ssl-default-server-ciphers ECDHE-ECDSA-AES256-GCM-SHA384:ECDHE-RSA-AES256-GCM-SHA384:ECDHE-ECDSA-CHACHA20-POLY1305:ECDHE-RSA-CHACHA20-POLY1305:ECDHE-ECDSA-AES128-GCM-SHA256:ECDHE-RSA-AES128-GCM-SHA256:ECDHE-ECDSA-AES256-SHA384:ECDHE-RSA-AES256-SHA384:ECDHE-ECDSA-AES128-SHA256:ECDHE-RSA-AES128-SHA256
-	ssl-default-server-options no-sslv3 no-tlsv10 no-tlsv11 no-tls-tickets
-defaults
-	log global
+	# The tuning (threads, connections, SSL...) and the defaults are generated
+	# by Plimni in haproxy-global.cfg
 EOF
 			}
 
@@ -78,6 +72,9 @@ EOF
 					"--haproxy-services-conf-file", "${NOMAD_ALLOC_DIR}/data/haproxy-services.cfg",
 					"--haproxy-pid-file", "${NOMAD_ALLOC_DIR}/data/haproxy.pid",
 					"--haproxy-sanitize-conf-folder", "${NOMAD_ALLOC_DIR}/data/sanitize.d",
+					"--haproxy-global-conf-file", "${NOMAD_ALLOC_DIR}/data/haproxy-global.cfg",
+					# The memory of the haproxy task
+					"--haproxy-memory", "500Mi",
 					"--certbot-conf-folder", "/certs",
 				]
 				network_mode = "host"
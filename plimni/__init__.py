@@ -16,14 +16,31 @@
 # See the documentations for required annotations / tags depending on your
 # cluster type.
 
+import logging
 import os
 import signal
 import sys
 import time
 
+import plimni.cache
+import plimni.certificates
 import plimni.clients
 import plimni.configuration
+import plimni.leader
+import plimni.logs
+import plimni.metrics
+import plimni.runtime
+import plimni.scheduler
+import plimni.snapshot
 import plimni.services
+import plimni.templating
+import plimni.tuning
+
+logger = logging.getLogger(__name__)
+
+# In watch mode, how long Plimni can go without a run when no change is
+# notified, in seconds; this run retries the sources which failed
+WATCH_MAX_IDLE = 300
 
 
 def reload_haproxy(pid_file: str) -> int:
@@ -48,24 +65,229 @@ def reload_haproxy(pid_file: str) -> int:
     return pid
 
 
+def save_servers_state(runtime_api: plimni.runtime.RuntimeAPI,
+                       state_file: str):
+    """
+    Dump the state of the servers of the running HAProxy to `state_file`, for
+    the next HAProxy process to load it.
+    """
+    state = runtime_api.execute(["show servers state"])
+
+    # HAProxy must never read a partially written file
+    with open(state_file + ".tmp", "w") as file_:
+        file_.write(state)
+
+    os.rename(state_file + ".tmp", state_file)
+
+
 def main(orchestrator: str, cluster_domain: str, cluster_email: str,
          cluster_branch: str, private_ip: str, init: bool, sleep_time: int,
-         haproxy_services_conf_file: str, haproxy_pid_file: str,
-         haproxy_sanitize_conf_folder: str, certbot_conf_folder: str):
-    print("Starting plimni")
+         watch: bool, consul_host: str, consul_port: int,
+         consul_datacenter: str, consul_concurrency: int,
+         consul_timeout: float,
+         consul_health: bool, k8s_endpoint_slices: bool, k8s_namespace: str,
+         sources: list, source_timeout: float,
+         haproxy_services_conf_file: str, haproxy_hosts_map_file: str,
+         haproxy_server_state_file: str, haproxy_crt_list_file: str,
+         haproxy_pid_file: str, haproxy_sanitize_conf_folder: str,
+         certbot_conf_folder: str, certificate_shards: int,
+         template_cache_folder: str, haproxy_runtime_api: bool,
+         haproxy_stats_socket: str, reload_debounce: float,
+         reload_min_interval: float, reload_max_delay: float,
+         metrics_port: int, log_level: str, log_format: str,
+         snapshot_file: str, snapshot_max_age: float, leader_election: str,
+         leader_key: str, leader_identity: str, leader_ttl: float,
+         haproxy_global_conf_file: str, haproxy_cpus: int,
+         haproxy_memory: int, haproxy_maxconn: int, haproxy_bufsize: int,
+         haproxy_cpu_map: bool):
+    plimni.logs.setup(level=log_level, format_=log_format)
+
+    logger.info("Starting plimni")
+
+    if metrics_port:
+        logger.info("Exposing metrics on port %d", metrics_port)
+        plimni.metrics.start(metrics_port)
 
-    client = plimni.clients.get_client(orchestrator)
+    plimni.templating.setup(bytecode_cache_folder=template_cache_folder)
+
+    client_settings = dict(
+        watch=watch,
+        consul_host=consul_host,
+        consul_port=consul_port,
+        consul_datacenter=consul_datacenter,
+        consul_concurrency=consul_concurrency,
+        consul_timeout=consul_timeout,
+        consul_health=consul_health,
+        k8s_endpoint_slices=k8s_endpoint_slices,
+        k8s_namespace=k8s_namespace,
+    )
+
+    if sources:
+        logger.info("Retrieving the services of %s", ", ".join(sources))
+        client = plimni.clients.get_composite_client(
+            sources,
+            timeout=source_timeout,
+            **client_settings
+        )
+    else:
+        client = plimni.clients.get_client(orchestrator, **client_settings)
 
     certbot_url = client.get_certbot_url(private_ip)
 
-    while True:
-        services = client.get_services(
+    # Rendered configuration fragments and digests of the written files are
+    # kept from one run to the next
+    fragment_cache = plimni.cache.FragmentCache()
+    digest_cache = plimni.cache.DigestCache()
+
+    # The Runtime API is used to save the servers state before reloads and,
+    # if enabled, to send servers changes to the running HAProxy instead of
+    # reloading it
+    runtime_api = plimni.runtime.RuntimeAPI(haproxy_stats_socket)
+    server_slots = None
+
+    if haproxy_runtime_api:
+        server_slots = plimni.runtime.ServerSlots()
+
+    # Certificates renewed by Certbot wake the main loop up
+    certificate_watcher = plimni.certificates.CertificateWatcher(
+        certbot_conf_folder=certbot_conf_folder,
+        on_change=client.notify_change,
+    )
+
+    # Reloads requested close to each other are merged into a single one
+    scheduler = plimni.scheduler.ReloadScheduler(
+        debounce=reload_debounce,
+        min_interval=reload_min_interval,
+        max_delay=reload_max_delay,
+    )
+
+    # With leader election, only the leader retrieves the services; the
+    # followers generate their configuration from the snapshot it publishes
+    election = None
+
+    if leader_election:
+        logger.info("Electing the leader through %s as %s", leader_election,
+                    leader_identity)
+        election = plimni.leader.Election(
+            store=plimni.leader.get_store(
+                leader_election,
+                key=leader_key,
+                consul_host=consul_host,
+                consul_port=consul_port,
+                consul_datacenter=consul_datacenter,
+                consul_timeout=consul_timeout,
+            ),
+            identity=leader_identity,
+            ttl=leader_ttl,
             cluster_branch=cluster_branch,
             cluster_domain=cluster_domain,
         )
 
+    # The global tuning of HAProxy only depends on the resources of the
+    # host, it is generated once
+    global_conf_changed = False
+
+    if haproxy_global_conf_file:
+        tuning = plimni.tuning.settings(
+            cpus=haproxy_cpus,
+            memory=haproxy_memory,
+            maxconn=haproxy_maxconn,
+            bufsize=haproxy_bufsize,
+            cpu_map=haproxy_cpu_map,
+        )
+        logger.info("Tuning HAProxy for %d CPUs and %d MiB of memory: %d "
+                    "threads, %d connections", tuning["cpus"],
+                    tuning["memory"] // 1024 // 1024, tuning["nbthread"],
+                    tuning["maxconn"])
+
+        global_conf = plimni.tuning.render(tuning)
+        global_conf_changed = digest_cache.has_changed(
+            haproxy_global_conf_file, global_conf,
+        )
+
+        if global_conf_changed:
+            logger.debug("HAProxy global tuning changed, writing the new one")
+
+            with open(haproxy_global_conf_file, "w") as file_:
+                file_.write(global_conf)
+
+    haproxy_structure = None
+    hosts_map = None
+    last_services = None
+
+    # The services of the last snapshot are rendered before the cluster is
+    # scanned, so HAProxy can start without waiting for the scan
+    snapshot_services = None
+    snapshot_fingerprints = None
+
+    if snapshot_file:
+        snapshot_services = plimni.snapshot.load(
+            file_path=snapshot_file,
+            max_age=snapshot_max_age,
+            cluster_branch=cluster_branch,
+            cluster_domain=cluster_domain,
+        )
+
+    while True:
+        # Durations of the phases of the run, in seconds
+        durations = {}
+        started = time.perf_counter()
+
+        from_snapshot = snapshot_services is not None
+        discovered = False
+
+        if from_snapshot:
+            logger.info("Rendering the %d services of the snapshot before "
+                        "scanning the cluster", len(snapshot_services))
+            services = snapshot_services
+            snapshot_services = None
+        else:
+            services = None
+
+            # The init mode only starts HAProxy, it does not take part in the
+            # election
+            if election is not None and (init or not election.is_leader()):
+                # The services of the previous run are kept until the leader
+                # publishes new ones, unless they were not the leader's
+                services = election.fetch()
+                if services is None and not election.fallback:
+                    services = last_services
+
+            # Until there is something from the leader, followers retrieve
+            # the services themselves
+            if services is None:
+                try:
+                    services = client.get_services(
+                        cluster_branch=cluster_branch,
+                        cluster_domain=cluster_domain,
+                    )
+                except plimni.clients.DiscoveryError as exc:
+                    # Rendering now would drop the services not retrieved
+                    logger.warning("Skipping the run, retrying in %s "
+                                   "seconds: %s", sleep_time, exc)
+                    client.wait_for_change(sleep_time)
+                    continue
+
+                discovered = True
+
+        last_services = services
+        durations["discovery"] = time.perf_counter() - started
+
+        if discovered:
+            plimni.metrics.DISCOVERY_SECONDS.observe(durations["discovery"])
+
+        exposed = [svc for svc in services if svc.expose]
+        backends = sum(len(svc.backends) for svc in exposed)
+        plimni.metrics.EXPOSED_SERVICES.set(len(exposed))
+        plimni.metrics.BACKENDS.set(backends)
+
+        started = time.perf_counter()
+
         configuration = plimni.configuration.Configuration(
             haproxy_services_conf_file=haproxy_services_conf_file,
+            haproxy_hosts_map_file=haproxy_hosts_map_file,
+            haproxy_server_state_file=haproxy_server_state_file,
+            haproxy_crt_list_file=haproxy_crt_list_file,
             haproxy_sanitize_conf_folder=haproxy_sanitize_conf_folder,
             certbot_conf_folder=certbot_conf_folder,
             cluster_domain=cluster_domain,
@@ -73,35 +295,210 @@ def main(orchestrator: str, cluster_domain: str, cluster_email: str,
             cluster_branch=cluster_branch,
             services=services,
             certbot_url=certbot_url,
+            fragment_cache=fragment_cache,
+            digest_cache=digest_cache,
+            server_slots=server_slots,
+            certificate_shards=certificate_shards,
         )
 
+        durations["render"] = time.perf_counter() - started
+        plimni.metrics.RENDER_SECONDS.observe(durations["render"])
+
+        for file_name, size in configuration.sizes().items():
+            plimni.metrics.CONFIG_SIZE.labels(file_name).set(size)
+
+        started = time.perf_counter()
+
         haproxy_changed = configuration.haproxy_changed()
+        hosts_map_changed = configuration.hosts_map_changed()
+        crt_list_changed = configuration.crt_list_changed()
         sanitize_changed = configuration.sanitize_changed()
+        certbot_changed = configuration.certbot_changed()
 
         if haproxy_changed:
-            print("HAProxy configuration changed, writing the new one")
+            logger.debug("HAProxy configuration changed, writing the new one")
             configuration.haproxy_write()
 
+        if hosts_map_changed:
+            logger.debug("HAProxy hosts map changed, writing the new one")
+            configuration.hosts_map_write()
+
+        if crt_list_changed:
+            logger.debug("HAProxy crt-list changed, writing the new one")
+            configuration.crt_list_write()
+
         if sanitize_changed:
-            print("Sanitized values changed, writing new ones")
+            logger.debug("Sanitized values changed, writing new ones")
             configuration.sanitize_write()
 
-        if configuration.certbot_changed():
-            print("Certbot configuration changed, writing the new one")
+        if certbot_changed:
+            logger.debug("Certbot configuration changed, writing the new one")
             configuration.certbot_write()
 
+        durations["write"] = time.perf_counter() - started
+        plimni.metrics.WRITE_SECONDS.observe(durations["write"])
+
+        written = [
+            name for name, changed in (
+                ("haproxy", haproxy_changed),
+                ("hosts_map", hosts_map_changed),
+                ("crt_list", crt_list_changed),
+                ("sanitize", sanitize_changed),
+                ("certbot", certbot_changed),
+            ) if changed
+        ]
+
+        # One line per run, the details are logged at the debug level
+        logger.info(
+            "Run done: %d services (%d exposed, %d backends) in %.3fs "
+            "(discovery %.3fs, render %.3fs, write %.3fs), written: %s",
+            len(services), len(exposed), backends, sum(durations.values()),
+            durations["discovery"], durations["render"], durations["write"],
+            ", ".join(written) or "nothing",
+            extra={
+                "services": len(services),
+                "exposed": len(exposed),
+                "backends": backends,
+                "durations": {
+                    phase: round(duration, 4)
+                    for phase, duration in durations.items()
+                },
+                "written": written,
+            },
+        )
+
+        if snapshot_file and not from_snapshot:
+            fingerprints = tuple(svc.fingerprint() for svc in services)
+
+            if fingerprints != snapshot_fingerprints:
+                try:
+                    plimni.snapshot.save(
+                        file_path=snapshot_file,
+                        services=services,
+                        cluster_branch=cluster_branch,
+                        cluster_domain=cluster_domain,
+                    )
+                    snapshot_fingerprints = fingerprints
+                except OSError as exc:
+                    logger.warning("Error when saving the snapshot: %s", exc)
+
+        if discovered and election is not None and election.leader:
+            election.publish(services)
+
         if init:
-            print("End of init mode, exiting")
+            logger.info("End of init mode, exiting")
             return
 
-        if haproxy_changed or sanitize_changed:
-            print("Reloading HAProxy")
+        runtime_changes = []
+        if server_slots is not None:
+            runtime_changes = server_slots.pop_changes()
+
+        if hosts_map_changed and hosts_map is not None:
+            runtime_changes += plimni.runtime.map_changes(
+                map_file=haproxy_hosts_map_file,
+                old=hosts_map,
+                new=configuration.hosts_map,
+            )
+
+        # Without the Runtime API, or if the configuration structure changed
+        # (new services, sanitized codes, certificates...), HAProxy has to
+        # reload
+        reload = sanitize_changed or crt_list_changed or (
+            not haproxy_runtime_api and (haproxy_changed or hosts_map_changed)
+        ) or (haproxy_changed and (
+            configuration.haproxy_structure != haproxy_structure
+        )) or (hosts_map_changed and hosts_map is None) or global_conf_changed
+        haproxy_structure = configuration.haproxy_structure
+        hosts_map = configuration.hosts_map
+        global_conf_changed = False
+
+        # Renewed certificates are sent to the running HAProxy through the
+        # Runtime API; without it, HAProxy has to reload to load them
+        cert_changes = certificate_watcher.changes(
+            configuration.https_cert_files,
+        )
+
+        if cert_changes and not haproxy_runtime_api:
+            logger.info("%d certificates changed, reloading HAProxy",
+                        len(cert_changes))
+            reload = True
+
+        if not reload and runtime_changes:
+            logger.info("Applying %d servers changes through the HAProxy "
+                        "Runtime API", len(runtime_changes))
+
+            try:
+                runtime_api.execute(runtime_changes)
+            except Exception as exc:
+                logger.error("Error when applying servers changes, reloading "
+                             "HAProxy instead: %s", exc)
+                reload = True
+
+        if not reload and cert_changes:
+            logger.info("Updating %d certificates through the HAProxy Runtime "
+                        "API", len(cert_changes))
+
+            try:
+                for cert_file, content in sorted(cert_changes.items()):
+                    runtime_api.set_ssl_cert(cert_file, content)
+                    plimni.metrics.CERTIFICATES_UPDATED.inc()
+            except Exception as exc:
+                logger.error("Error when updating certificates, reloading "
+                             "HAProxy instead: %s", exc)
+                reload = True
+
+        if reload:
+            if scheduler.pending:
+                plimni.metrics.RELOADS_AVOIDED.inc()
+            scheduler.request()
+
+        if scheduler.is_due():
+            logger.debug("Saving the servers state")
+
+            try:
+                save_servers_state(runtime_api, haproxy_server_state_file)
+            except Exception as exc:
+                logger.warning("Error when saving the servers state, HAProxy "
+                               "will start with fresh servers: %s", exc)
 
             try:
                 hap_pid = reload_haproxy(haproxy_pid_file)
-                print("Reloaded HAProxy master process PID {}".format(hap_pid))
+                plimni.metrics.RELOADS.inc()
+                logger.info("Reloaded HAProxy master process PID %d (%d "
+                            "reloads avoided so far)", hap_pid,
+                            scheduler.avoided)
             except Exception as exc:
-                print("Error when reloading HAProxy: {}".format(str(exc)))
+                plimni.metrics.RELOAD_FAILURES.inc()
+                logger.error("Error when reloading HAProxy: %s", exc)
+
+            scheduler.reloaded()
+
+        if from_snapshot:
+            # Reconcile with the cluster right away
+            continue
+
+        timeout = sleep_time
+
+        if scheduler.pending:
+            # Wake up in time for the pending reload
+            timeout = min(timeout, scheduler.due_in())
+            logger.info("HAProxy reload delayed by %.1f seconds to merge "
+                        "changes", timeout)
+
+        logger.debug("All done, waiting for changes for at most %s seconds",
+                     timeout)
+
+        # In watch mode, every change is notified: without one, the run is
+        # skipped unless a reload is due, the leadership has to be renewed
+        # (or the snapshot of the leader fetched) or the certificates can
+        # only be polled
+        idle = watch and election is None and certificate_watcher.watching
+        idle_until = time.monotonic() + WATCH_MAX_IDLE
 
-        print("All done, sleeping {} seconds".format(sleep_time))
-        time.sleep(sleep_time)
+        while not client.wait_for_change(timeout):
+            if not idle or scheduler.pending or time.monotonic() >= idle_until:
+                break
+            logger.debug("No change notified in %s seconds, waiting again",
+                         timeout)
+        else:
+            logger.debug("Changes detected in the cluster")
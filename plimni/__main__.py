@@ -2,9 +2,10 @@
 
 import argparse
 import os
+import socket
 import sys
 
-from . import main
+from . import leader, logs, main, tuning
 
 
 parser = argparse.ArgumentParser("plimni")
@@ -54,11 +55,141 @@ parser.add_argument(
     help="The time Plimni will wait between runs",
 )
 
+parser.add_argument(
+    "--watch",
+    default=False,
+    const=True,
+    nargs="?",
+    help=("Whether to watch the cluster for changes (Kubernetes watches or "
+          "Consul blocking queries) instead of polling it; runs then only "
+          "happen on changes, or every sleep time with a leader election or "
+          "without inotify"),
+)
+
+parser.add_argument(
+    "--reload-debounce",
+    type=float,
+    default=1,
+    help=("How long Plimni waits for other changes before reloading HAProxy, "
+          "in seconds"),
+)
+
+parser.add_argument(
+    "--reload-min-interval",
+    type=float,
+    default=5,
+    help="The minimum time between 2 HAProxy reloads, in seconds",
+)
+
+parser.add_argument(
+    "--reload-max-delay",
+    type=float,
+    default=30,
+    help="The maximum time an HAProxy reload can be delayed, in seconds",
+)
+
+parser.add_argument(
+    "--k8s-endpoint-slices",
+    default=False,
+    const=True,
+    nargs="?",
+    help=("Whether to read the services backends from EndpointSlices instead "
+          "of Endpoints (Kubernetes only)"),
+)
+
+parser.add_argument(
+    "--k8s-namespace",
+    default="default",
+    help="The namespace to retrieve the services from (Kubernetes only)",
+)
+
+parser.add_argument(
+    "--source",
+    dest="sources",
+    action="append",
+    help=("A source to retrieve services from, as `<orchestrator>[:<option>="
+          "<value>,...]` (e.g. `k8s:namespace=shop` or `nomad:host=10.0.0.1,"
+          "dc=eu`); can be given several times, the sources are then "
+          "queried concurrently (defaults to the orchestrator)"),
+)
+
+parser.add_argument(
+    "--source-timeout",
+    type=float,
+    default=30,
+    help=("How long Plimni waits for each source before using its services "
+          "of the previous run, in seconds (sources can override it with a "
+          "`timeout` option)"),
+)
+
+parser.add_argument(
+    "--consul-host",
+    default="127.0.0.1",
+    help=("The Consul agent to retrieve services from and to elect the "
+          "leader through (Nomad sources can override it with a `host` "
+          "option)"),
+)
+
+parser.add_argument(
+    "--consul-port",
+    type=int,
+    default=8500,
+    help=("The HTTP port of the Consul agent (Nomad sources can override it "
+          "with a `port` option)"),
+)
+
+parser.add_argument(
+    "--consul-datacenter",
+    help=("The Consul datacenter to query (defaults to the datacenter of the "
+          "agent; Nomad sources can override it with a `dc` option)"),
+)
+
+parser.add_argument(
+    "--consul-concurrency",
+    type=int,
+    default=10,
+    help=("How many requests Plimni sends concurrently to Consul when "
+          "retrieving services (Nomad only)"),
+)
+
+parser.add_argument(
+    "--consul-timeout",
+    type=float,
+    default=10,
+    help="How long Plimni waits for Consul to answer, in seconds (Nomad only)",
+)
+
+parser.add_argument(
+    "--consul-health",
+    default=False,
+    const=True,
+    nargs="?",
+    help=("Whether to only route traffic to the services instances passing "
+          "their Consul health checks, with their Consul weights (Nomad "
+          "only)"),
+)
+
 parser.add_argument(
     "--haproxy-services-conf-file",
     default="/usr/local/etc/haproxy/conf.d/services.cfg",
     help="The HAProxy services configuration file to manage",
 )
+parser.add_argument(
+    "--haproxy-hosts-map-file",
+    help=("The HAProxy map routing FQDNs to backends (defaults to "
+          "`hosts.map` next to the services configuration file)"),
+)
+parser.add_argument(
+    "--haproxy-server-state-file",
+    help=("Where to save the HAProxy servers state before reloading it "
+          "(defaults to `server-state` next to the services configuration "
+          "file)"),
+)
+parser.add_argument(
+    "--haproxy-crt-list-file",
+    help=("The HAProxy crt-list listing the certificates to serve (defaults "
+          "to `crt-list` next to the services configuration file)"),
+)
 parser.add_argument(
     "--haproxy-pid-file",
     default="/usr/local/etc/haproxy/conf.d/haproxy.pid",
@@ -74,6 +205,128 @@ parser.add_argument(
     default="/usr/local/etc/haproxy/certs",
     help="The Certbot configuration folder to manage",
 )
+parser.add_argument(
+    "--certificate-shards",
+    type=int,
+    default=1,
+    help=("How many certificates the domains of the HTTPS services are split "
+          "between, so that a new service only re-issues one of them"),
+)
+parser.add_argument(
+    "--haproxy-runtime-api",
+    default=False,
+    const=True,
+    nargs="?",
+    help=("Whether to apply servers changes through the HAProxy Runtime API "
+          "instead of reloading HAProxy"),
+)
+parser.add_argument(
+    "--haproxy-stats-socket",
+    help=("The HAProxy stats socket the Runtime API is reached through "
+          "(defaults to `stats.sock` next to the services configuration "
+          "file)"),
+)
+parser.add_argument(
+    "--haproxy-global-conf-file",
+    help=("The HAProxy global tuning file to manage (threads, connections, "
+          "buffers...), generated from the CPUs and memory available "
+          "(disabled if not set)"),
+)
+parser.add_argument(
+    "--haproxy-cpus",
+    type=int,
+    help=("How many CPUs HAProxy can use (defaults to the CPUs available to "
+          "Plimni, within its cgroup CPU quota)"),
+)
+parser.add_argument(
+    "--haproxy-memory",
+    type=tuning.parse_memory,
+    help=("How much memory HAProxy can use, e.g. `2Gi` (defaults to the "
+          "memory available to Plimni, within its cgroup memory limit)"),
+)
+parser.add_argument(
+    "--haproxy-maxconn",
+    type=int,
+    help=("The maximum number of concurrent connections of HAProxy "
+          "(defaults to what its memory can hold)"),
+)
+parser.add_argument(
+    "--haproxy-bufsize",
+    type=int,
+    default=16384,
+    help="The size of the HAProxy buffers, in bytes",
+)
+parser.add_argument(
+    "--haproxy-cpu-map",
+    default=False,
+    const=True,
+    nargs="?",
+    help=("Whether to pin each HAProxy thread to one of the CPUs Plimni can "
+          "run on; only if HAProxy runs on the same CPUs"),
+)
+parser.add_argument(
+    "--log-level",
+    choices=logs.LEVELS,
+    default="info",
+    help="The minimum level of the logs",
+)
+parser.add_argument(
+    "--log-format",
+    choices=logs.FORMATS,
+    default="text",
+    help="The format of the logs",
+)
+parser.add_argument(
+    "--metrics-port",
+    type=int,
+    help=("The port to expose Prometheus metrics on (disabled if not "
+          "set)"),
+)
+parser.add_argument(
+    "--snapshot-file",
+    help=("Where to save the last known services, to generate the "
+          "configuration from them when Plimni starts, before scanning the "
+          "cluster (disabled if not set)"),
+)
+parser.add_argument(
+    "--snapshot-max-age",
+    type=float,
+    default=3600,
+    help="How old a snapshot can be to be used, in seconds",
+)
+parser.add_argument(
+    "--leader-election",
+    choices=leader.STORES,
+    help=("Where to elect a leader among the Plimni instances: only the "
+          "leader retrieves the services, the others generate their "
+          "configuration from the snapshot it publishes there (disabled if "
+          "not set)"),
+)
+parser.add_argument(
+    "--leader-key",
+    default="plimni",
+    help=("The prefix of the Consul KV entries, the prefix of the names of "
+          "the Kubernetes Lease and ConfigMap, or the shared folder used for "
+          "the leader election"),
+)
+parser.add_argument(
+    "--leader-identity",
+    default=socket.gethostname(),
+    help=("The name of this instance in the election (defaults to the "
+          "hostname)"),
+)
+parser.add_argument(
+    "--leader-ttl",
+    type=float,
+    default=30,
+    help=("How long the leadership lasts if the leader stops renewing it, in "
+          "seconds; must be longer than the sleep time"),
+)
+parser.add_argument(
+    "--template-cache-folder",
+    help=("Where to store the compiled templates so they are not compiled "
+          "again when Plimni restarts (disabled if not set)"),
+)
 
 args = parser.parse_args()
 
@@ -92,6 +345,38 @@ if args.orchestrator == "nomad" and not args.private_ip:
     parser.print_help(sys.stderr)
     sys.exit(1)
 
+if args.leader_election and args.leader_ttl <= args.sleep_time:
+    parser.print_help(sys.stderr)
+    sys.exit(1)
+
+if args.certificate_shards < 1:
+    parser.print_help(sys.stderr)
+    sys.exit(1)
+
+if args.haproxy_cpus is not None and args.haproxy_cpus < 1:
+    parser.print_help(sys.stderr)
+    sys.exit(1)
+
+if not args.haproxy_hosts_map_file:
+    args.haproxy_hosts_map_file = os.path.join(
+        os.path.dirname(args.haproxy_services_conf_file), "hosts.map",
+    )
+
+if not args.haproxy_server_state_file:
+    args.haproxy_server_state_file = os.path.join(
+        os.path.dirname(args.haproxy_services_conf_file), "server-state",
+    )
+
+if not args.haproxy_crt_list_file:
+    args.haproxy_crt_list_file = os.path.join(
+        os.path.dirname(args.haproxy_services_conf_file), "crt-list",
+    )
+
+if not args.haproxy_stats_socket:
+    args.haproxy_stats_socket = os.path.join(
+        os.path.dirname(args.haproxy_services_conf_file), "stats.sock",
+    )
+
 
 main(
     orchestrator=args.orchestrator,
@@ -101,8 +386,44 @@ main(
     private_ip=args.private_ip,
     init=args.init,
     sleep_time=args.sleep_time,
+    watch=args.watch,
+    consul_host=args.consul_host,
+    consul_port=args.consul_port,
+    consul_datacenter=args.consul_datacenter,
+    consul_concurrency=args.consul_concurrency,
+    consul_timeout=args.consul_timeout,
+    consul_health=args.consul_health,
+    k8s_endpoint_slices=args.k8s_endpoint_slices,
+    k8s_namespace=args.k8s_namespace,
+    sources=args.sources,
+    source_timeout=args.source_timeout,
     haproxy_services_conf_file=args.haproxy_services_conf_file,
+    haproxy_hosts_map_file=args.haproxy_hosts_map_file,
+    haproxy_server_state_file=args.haproxy_server_state_file,
+    haproxy_crt_list_file=args.haproxy_crt_list_file,
     haproxy_pid_file=args.haproxy_pid_file,
     haproxy_sanitize_conf_folder=args.haproxy_sanitize_conf_folder,
-    certbot_conf_folder=args.certbot_conf_folder
+    certbot_conf_folder=args.certbot_conf_folder,
+    certificate_shards=args.certificate_shards,
+    template_cache_folder=args.template_cache_folder,
+    haproxy_runtime_api=args.haproxy_runtime_api,
+    haproxy_stats_socket=args.haproxy_stats_socket,
+    reload_debounce=args.reload_debounce,
+    reload_min_interval=args.reload_min_interval,
+    reload_max_delay=args.reload_max_delay,
+    metrics_port=args.metrics_port,
+    log_level=args.log_level,
+    log_format=args.log_format,
+    snapshot_file=args.snapshot_file,
+    snapshot_max_age=args.snapshot_max_age,
+    leader_election=args.leader_election,
+    leader_key=args.leader_key,
+    leader_identity=args.leader_identity,
+    leader_ttl=args.leader_ttl,
+    haproxy_global_conf_file=args.haproxy_global_conf_file,
+    haproxy_cpus=args.haproxy_cpus,
+    haproxy_memory=args.haproxy_memory,
+    haproxy_maxconn=args.haproxy_maxconn,
+    haproxy_bufsize=args.haproxy_bufsize,
+    haproxy_cpu_map=args.haproxy_cpu_map,
 )
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import typing
+
+
+class FragmentCache():
+    """
+    Keep rendered configuration fragments in memory, indexed by a key
+    describing everything they were rendered from, so unchanged fragments
+    don't have to be rendered again.
+
+    The fragments which were not used since the previous call to `rotate` are
+    dropped by the next one, so the cache only holds what the current
+    configuration is made of.
+    """
+    def __init__(self):
+        self._fragments = {}
+        self._used = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: typing.Hashable,
+            render: typing.Callable[[], str]) -> str:
+        """Return the fragment `key`, rendering it with `render` if needed."""
+        fragment = self._used.get(key)
+
+        if fragment is not None:
+            self.hits += 1
+            return fragment
+
+        fragment = self._fragments.get(key)
+
+        if fragment is None:
+            self.misses += 1
+            fragment = render()
+        else:
+            self.hits += 1
+
+        self._used[key] = fragment
+
+        return fragment
+
+    def rotate(self):
+        """Drop the fragments which were not used since the last rotation."""
+        self._fragments = self._used
+        self._used = {}
+
+
+class DigestCache():
+    """
+    Remember the digest of the files Plimni read or wrote, along with their
+    signature on disk (inode, size and modification time), so a file is only
+    read and hashed again when it was changed by someone else.
+
+    A key describing what the content was generated from can be stored along:
+    when the key is the same, the new content does not even need to be
+    hashed.
+    """
+    def __init__(self):
+        # path => (signature, digest, key)
+        self._entries = {}
+
+    @staticmethod
+    def _signature(file_path: str) -> tuple:
+        stat = os.stat(file_path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def _digest(content: str) -> str:
+        return hashlib.blake2b(content.encode("utf-8")).hexdigest()
+
+    def has_changed(self, file_path: str, content: str,
+                    key: typing.Hashable = None) -> bool:
+        """
+        Return whether `content` differs from the content of `file_path`.
+        """
+        try:
+            signature = DigestCache._signature(file_path)
+        except FileNotFoundError:
+            self._entries.pop(file_path, None)
+            return bool(content)
+
+        entry = self._entries.get(file_path)
+
+        if entry is not None and entry[0] == signature:
+            if key is not None and entry[2] == key:
+                return False
+
+            old_digest = entry[1]
+        else:
+            with open(file_path, "r") as file_:
+                old_digest = DigestCache._digest(file_.read())
+
+        changed = DigestCache._digest(content) != old_digest
+
+        # The key only describes the file if the content matches it
+        self._entries[file_path] = (
+            signature, old_digest, key if not changed else None,
+        )
+
+        return changed
+
+    def written(self, file_path: str, content: str,
+                key: typing.Hashable = None):
+        """Remember that `content` was just written to `file_path`."""
+        self._entries[file_path] = (
+            DigestCache._signature(file_path),
+            DigestCache._digest(content),
+            key,
+        )
@@ -0,0 +1,202 @@
+import logging
+import os
+import threading
+import typing
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+
+class CertificateWatcher():
+    """
+    Tell which certificates Certbot renewed or expanded since the last run.
+
+    The certificates files are compared to what they were at the previous
+    call to `changes`, so this works by polling on every run. If
+    `inotify_simple` is installed, the Certbot folder is also watched with
+    inotify to call `on_change` as soon as a certificate is written, instead
+    of waiting for the next run.
+
+    Args:
+        certbot_conf_folder (str): The Certbot working directory, where the
+                                   certificates are in `live/`.
+        on_change (callable): Called (from another thread) when a certificate
+                              was written.
+    """
+    # The deploy hook writes the private key then the full chain
+    BUNDLE_FILE = "bundle.pem"
+    BUNDLE_END = "-----END CERTIFICATE-----"
+
+    def __init__(self, certbot_conf_folder: str,
+                 on_change: typing.Callable[[], None] = None):
+        self.certbot_conf_folder = certbot_conf_folder
+        self._on_change = on_change
+
+        # path => signature of the file (inode, size and modification time)
+        self._signatures = {}
+
+        # Whether `on_change` is called for every certificate written, so
+        # there is no need to poll them: set once inotify watches the Certbot
+        # folder
+        self.watching = False
+
+        if on_change is not None and inotify_simple is not None:
+            threading.Thread(target=self._watch_loop, daemon=True).start()
+        elif on_change is not None:
+            logger.info("inotify_simple is not installed, certificates are "
+                        "only checked on every run")
+
+    @staticmethod
+    def _signature(file_path: str) -> tuple:
+        stat = os.stat(file_path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def changes(self, cert_files: typing.List[str]) -> typing.Dict[str, str]:
+        """
+        Return the content of the files of `cert_files` which changed since
+        the previous call, indexed by their path.
+
+        Files seen for the first time are not returned: HAProxy loaded them
+        when it started. Files still being written are returned once
+        complete.
+        """
+        changed = {}
+
+        for file_path in cert_files:
+            try:
+                signature = CertificateWatcher._signature(file_path)
+            except FileNotFoundError:
+                self._signatures.pop(file_path, None)
+                continue
+
+            previous = self._signatures.get(file_path)
+
+            if previous == signature:
+                continue
+
+            if previous is not None:
+                with open(file_path, "r") as file_:
+                    content = file_.read()
+
+                if not content.rstrip().endswith(
+                        CertificateWatcher.BUNDLE_END):
+                    logger.debug("Certificate %s is being written", file_path)
+                    continue
+
+                changed[file_path] = content
+
+            self._signatures[file_path] = signature
+
+        return changed
+
+    def _folders(self) -> typing.List[str]:
+        """
+        Return the folders to watch: the Certbot folder, `live/` and the
+        folder of each certificate or, until Certbot created its folder, its
+        closest existing parent.
+        """
+        folder = os.path.abspath(self.certbot_conf_folder)
+
+        while not os.path.isdir(folder):
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                return []
+            folder = parent
+
+        if folder != os.path.abspath(self.certbot_conf_folder):
+            return [folder]
+
+        # Certbot creates `live/` then one folder per certificate in it
+        live = os.path.join(folder, "live")
+        folders = [folder]
+
+        try:
+            folders.extend([live] + [
+                os.path.join(live, name) for name in sorted(os.listdir(live))
+            ])
+        except OSError:
+            # Certbot did not create it yet
+            pass
+
+        return folders
+
+    def _watch_loop(self):
+        inotify = inotify_simple.INotify()
+        flags = inotify_simple.flags
+        mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO
+
+        # watch descriptor => watched folder
+        folders = {}
+
+        def watch() -> bool:
+            """
+            Update the watched folders; return whether a certificate was
+            written in a folder before it was watched.
+            """
+            wanted = None
+            written = False
+
+            # Folders created before their parent was watched are only seen
+            # by listing them again
+            while wanted != self._folders():
+                wanted = self._folders()
+
+                for wd, folder in list(folders.items()):
+                    if folder not in wanted:
+                        try:
+                            inotify.rm_watch(wd)
+                        except OSError:
+                            # The folder was removed, and its watch with it
+                            pass
+                        del folders[wd]
+
+                for folder in wanted:
+                    if folder in folders.values():
+                        continue
+
+                    try:
+                        folders[inotify.add_watch(folder, mask)] = folder
+                    except OSError:
+                        # Removed since
+                        continue
+
+                    written = written or os.path.isfile(os.path.join(
+                        folder, CertificateWatcher.BUNDLE_FILE,
+                    ))
+
+            self.watching = os.path.abspath(self.certbot_conf_folder) \
+                in folders.values()
+
+            return written
+
+        watch()
+
+        if not self.watching:
+            logger.info("%s does not exist yet, it is watched until Certbot "
+                        "creates it", self.certbot_conf_folder)
+
+        while True:
+            notify = False
+
+            for event in inotify.read():
+                path = os.path.join(folders.get(event.wd, ""), event.name)
+
+                if event.mask & flags.IGNORED:
+                    # The folder was removed
+                    folders.pop(event.wd, None)
+                    self.watching = os.path.abspath(
+                        self.certbot_conf_folder
+                    ) in folders.values()
+                elif event.mask & flags.ISDIR:
+                    # The Certbot folder, `live/` or a certificate folder
+                    notify = watch() or notify
+                elif event.name == CertificateWatcher.BUNDLE_FILE:
+                    logger.debug("Certificate %s was written", path)
+                    notify = True
+
+            if notify:
+                self._on_change()
@@ -1,9 +1,33 @@
+import logging
+import threading
 import typing
 
-from .services import Service
+from .services import Service, ServiceFactory
+
+logger = logging.getLogger(__name__)
+
+
+class DiscoveryError(Exception):
+    """
+    Raised when the services can't all be retrieved yet; the run is skipped
+    rather than rendering an incomplete configuration.
+    """
 
 
 class Client():
+    def __init__(self):
+        # Set by event-driven clients whenever an exposed service changed, so
+        # the main loop can wake up before the end of its sleep time
+        self._changed = threading.Event()
+
+        # Services are only built again when their settings or backends
+        # changed
+        self._factory = ServiceFactory()
+
+        # Invalid services of the last run (name => error), to only log them
+        # when they become invalid
+        self._invalid = {}
+
     def get_services(
             self, cluster_branch: str, cluster_domain: str,
     ) -> typing.List[Service]:
@@ -14,14 +38,88 @@ class Client():
         """Return the Certbot URL for the given cluster."""
         raise NotImplementedError()
 
+    def _report_invalid(self, invalid: typing.Dict[str, str]):
+        """
+        Log why the services `invalid` (name => error) can't be processed,
+        once as long as they stay invalid for the same reason.
+        """
+        for name, error in sorted(invalid.items()):
+            if self._invalid.get(name) != error:
+                logger.warning("Can't process service %s because of: %s",
+                               name, error)
+            else:
+                logger.debug("Service %s is still invalid because of: %s",
+                             name, error)
+
+        self._invalid = invalid
+
+    def notify_change(self):
+        """Wake up whoever is waiting in `wait_for_change`."""
+        self._changed.set()
+
+    def share_changes(self, client: "Client"):
+        """Make the changes notified by this client wake `client` up."""
+        self._changed = client._changed
 
-def get_client(name: str) -> Client:
+    def wait_for_change(self, timeout: float) -> bool:
+        """
+        Block until the cluster changed or `timeout` seconds elapsed.
+
+        Polling clients never notify anything so this is a plain sleep for
+        them. Return whether a change was notified.
+        """
+        changed = self._changed.wait(timeout)
+        self._changed.clear()
+        return changed
+
+
+def get_client(name: str, watch: bool = False, consul_concurrency: int = 10,
+               consul_timeout: float = 10, consul_health: bool = False,
+               consul_host: str = "127.0.0.1", consul_port: int = 8500,
+               consul_datacenter: str = None,
+               k8s_endpoint_slices: bool = False,
+               k8s_namespace: str = "default",
+               k8s_context: str = None) -> Client:
     if name == "k8s":
         from . import k8s
-        return k8s.get_client()
+        return k8s.get_client(
+            watch=watch,
+            endpoint_slices=k8s_endpoint_slices,
+            namespace=k8s_namespace,
+            context=k8s_context,
+        )
     if name == "nomad":
         from . import nomad
-        return nomad.get_client()
+        return nomad.get_client(
+            watch=watch,
+            concurrency=consul_concurrency,
+            timeout=consul_timeout,
+            health=consul_health,
+            host=consul_host,
+            port=consul_port,
+            datacenter=consul_datacenter,
+        )
     else:
         raise NotImplementedError("The orchestrator {} is not implemented"
                                   "".format(name))
+
+
+def get_composite_client(sources: typing.List[str], timeout: float,
+                         **kwargs) -> Client:
+    """
+    Return a client retrieving the services of all the `sources` (see
+    `plimni.composite.parse_source`). `kwargs` are given to `get_client` for
+    every source, unless the source sets them itself.
+    """
+    from . import composite
+
+    clients = {}
+    timeouts = {}
+
+    for source in sources:
+        orchestrator, options, source_timeout = composite.parse_source(source)
+        clients[source] = get_client(orchestrator, **dict(kwargs, **options))
+        timeouts[source] = timeout if source_timeout is None \
+            else source_timeout
+
+    return composite.CompositeClient(clients, timeouts)
@@ -0,0 +1,198 @@
+import concurrent.futures
+import logging
+import time
+import typing
+
+import plimni.metrics
+from .clients import Client, DiscoveryError
+from .services import Service
+
+logger = logging.getLogger(__name__)
+
+# The options a source can be given, per orchestrator, and the arguments of
+# `plimni.clients.get_client` they set
+SOURCE_OPTIONS = {
+    "k8s": {
+        "namespace": ("k8s_namespace", str),
+        "context": ("k8s_context", str),
+    },
+    "nomad": {
+        "host": ("consul_host", str),
+        "port": ("consul_port", int),
+        "dc": ("consul_datacenter", str),
+    },
+}
+
+
+def parse_source(source: str) -> typing.Tuple[str, dict, float]:
+    """
+    Parse a source, written `<orchestrator>[:<option>=<value>,...]` (e.g.
+    `k8s:namespace=shop` or `nomad:host=10.0.0.1,dc=eu`), and return its
+    orchestrator, the arguments of `plimni.clients.get_client` it sets and
+    its timeout (`None` if not set).
+    """
+    orchestrator, _, options = source.partition(":")
+
+    if orchestrator not in SOURCE_OPTIONS:
+        raise ValueError("The source {} has an unknown orchestrator"
+                         "".format(source))
+
+    kwargs = {}
+    timeout = None
+
+    for option in filter(None, options.split(",")):
+        key, _, value = option.partition("=")
+
+        try:
+            if key == "timeout":
+                timeout = float(value)
+            else:
+                argument, type_ = SOURCE_OPTIONS[orchestrator][key]
+                kwargs[argument] = type_(value)
+        except KeyError as err:
+            raise ValueError("The source {} has an unknown option {}"
+                             "".format(source, key)) from err
+        except ValueError as err:
+            raise ValueError("The option {} of the source {} is not valid"
+                             "".format(key, source)) from err
+
+    return orchestrator, kwargs, timeout
+
+
+class CompositeClient(Client):
+    """
+    Retrieve the services of several sources (namespaces, clusters, Consul
+    datacenters...) concurrently and merge them.
+
+    A source which does not answer within its timeout does not delay the
+    run: its services of the previous run are used instead, and its
+    discovery is not started again until it finished. The same goes for a
+    source failing. Until every source answered once, there are no previous
+    services to use: `DiscoveryError` is raised so the run is skipped,
+    instead of removing the services of the missing sources.
+
+    When services of different sources share an FQDN, the service of the
+    source given first is kept and the other one is ignored.
+
+    Args:
+        sources (dict): The clients of the sources, indexed by their name, in
+                        order of precedence.
+        timeouts (dict): How long to wait for each source (by name), in
+                         seconds.
+    """
+    def __init__(self, sources: typing.Dict[str, Client],
+                 timeouts: typing.Dict[str, float]):
+        super().__init__()
+        self._sources = sources
+        self._timeouts = timeouts
+
+        # A change notified by any source wakes the main loop up
+        for source in sources.values():
+            source.share_changes(self)
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(sources),
+            thread_name_prefix="plimni-source",
+        )
+
+        # The discovery still running of each source (name => future) and the
+        # services retrieved by its last one (name => services)
+        self._running = {}
+        self._services = {}
+        # The sources whose running discovery did not answer in time
+        self._late = set()
+
+    def get_services(self, cluster_branch: str, cluster_domain: str):
+        started = time.monotonic()
+
+        for name, source in self._sources.items():
+            if name not in self._running:
+                self._running[name] = self._executor.submit(
+                    source.get_services,
+                    cluster_branch=cluster_branch,
+                    cluster_domain=cluster_domain,
+                )
+                self._running[name].add_done_callback(
+                    lambda _, name=name: self._answered(name)
+                )
+
+        for name, future in list(self._running.items()):
+            timeout = started + self._timeouts[name] - time.monotonic()
+            fallback = "using its services of the previous run" \
+                if name in self._services else "it never answered yet"
+
+            try:
+                self._services[name] = future.result(max(timeout, 0))
+            except concurrent.futures.TimeoutError:
+                logger.warning("Source %s did not answer within %s seconds, "
+                               "%s", name, self._timeouts[name], fallback)
+                self._late.add(name)
+                # It may have answered since
+                if future.done():
+                    self.notify_change()
+                continue
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Error when retrieving the services of the "
+                             "source %s, %s: %s", name, fallback, exc)
+
+            del self._running[name]
+            self._late.discard(name)
+
+        missing = [
+            name for name in self._sources if name not in self._services
+        ]
+
+        if missing:
+            raise DiscoveryError("the sources {} never answered yet".format(
+                ", ".join(missing),
+            ))
+
+        return self._merge()
+
+    def _answered(self, name: str):
+        """
+        Called when the discovery of the source `name` finished: its answer
+        is a change to wake the main loop up for if it came too late for its
+        run.
+        """
+        if name in self._late:
+            self.notify_change()
+
+    def _merge(self) -> typing.List[Service]:
+        """
+        Merge the services of all the sources, skipping the services with an
+        FQDN already taken by another service.
+        """
+        services = []
+        invalid = {}
+
+        # FQDN => (source, service name)
+        owners = {}
+
+        for name in self._sources:
+            for svc in self._services[name]:
+                fqdns = [fqdn.lower() for fqdn in
+                         (svc.fqdn,) + svc.additional_fqdns]
+                taken = [fqdn for fqdn in fqdns if fqdn in owners]
+
+                if taken:
+                    plimni.metrics.SERVICES_INVALID.inc()
+                    invalid["{}/{}".format(name, svc.name)] = (
+                        "its FQDN {} is already used by the service {} of "
+                        "the source {}".format(taken[0], owners[taken[0]][1],
+                                               owners[taken[0]][0])
+                    )
+                    continue
+
+                for fqdn in fqdns:
+                    owners[fqdn] = name, svc.name
+
+                services.append(svc)
+
+        self._report_invalid(invalid)
+
+        return services
+
+    def get_certbot_url(self, private_ip: str) -> str:
+        # Certbot runs next to Plimni, in the cluster of the first source
+        return next(iter(self._sources.values())).get_certbot_url(private_ip)
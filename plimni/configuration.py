@@ -1,29 +1,50 @@
-import hashlib
+import glob
+import logging
 import os
 import typing
+import zlib
 
-import jinja2
-
+import plimni.cache
+import plimni.runtime
 import plimni.services
+import plimni.templating
+
+logger = logging.getLogger(__name__)
 
 
 class Configuration():
-    HAPROXY_TEMPLATE = "./plimni/templates/haproxy.cfg.j2"
-    SANITIZE_TEMPLATE = "./plimni/templates/haproxy_sanitize_return.http.j2"
-    CERTBOT_TEMPLATE = "./plimni/templates/certbot.ini.j2"
+    HAPROXY_TEMPLATE = "haproxy.cfg.j2"
+    HAPROXY_BACKEND_TEMPLATE = "haproxy_backend.cfg.j2"
+    SANITIZE_TEMPLATE = "haproxy_sanitize_return.http.j2"
+    CERTBOT_TEMPLATE = "certbot.ini.j2"
+
+    # Service attributes which can be changed through the Runtime API (the
+    # additional FQDNs only are entries of the hosts map)
+    RUNTIME_ATTRIBUTES = ("backends", "expose", "additional_fqdns")
+
+    # ACME certificates can't have more names than that
+    CERTIFICATE_MAX_DOMAINS = 100
 
     def __init__(self, haproxy_services_conf_file: str,
+                 haproxy_hosts_map_file: str,
+                 haproxy_server_state_file: str,
+                 haproxy_crt_list_file: str,
                  haproxy_sanitize_conf_folder: str, certbot_conf_folder: str,
                  cluster_domain: str,
                  cluster_email: str,
                  cluster_branch: str,
                  services: typing.List[plimni.services.Service],
-                 certbot_url: str):
+                 certbot_url: str,
+                 fragment_cache: plimni.cache.FragmentCache = None,
+                 digest_cache: plimni.cache.DigestCache = None,
+                 server_slots: plimni.runtime.ServerSlots = None,
+                 certificate_shards: int = 1):
         self.haproxy_conf_file = haproxy_services_conf_file
+        self.hosts_map_file = haproxy_hosts_map_file
+        self.server_state_file = haproxy_server_state_file
+        self.crt_list_file = haproxy_crt_list_file
         self.sanitize_conf_folder = haproxy_sanitize_conf_folder
-        self.certbot_conf_file = "{}/cli.ini".format(certbot_conf_folder)
-        self.https_cert_file = ("{}/live/{}/bundle.pem"
-                                "".format(certbot_conf_folder, cluster_domain))
+        self.certbot_conf_folder = certbot_conf_folder
 
         if not cluster_email:
             cluster_email = "postmaster@{}".format(cluster_domain)
@@ -32,51 +53,175 @@ class Configuration():
 
         self._services = services
 
-        # Parse the services and generate the configuration files
-        self._haproxy_conf = Configuration._generate_haproxy_conf(
-            services=self._services,
-            https_cert_file=self.https_cert_file,
-            sanitize_conf_folder=self.sanitize_conf_folder,
-            cluster_domain=cluster_domain,
-            cluster_branch=cluster_branch,
-            certbot_url=certbot_url,
-        )
-        self._sanitize_confs = Configuration._generate_sanitize_confs(services)
-        self._certbot_conf = Configuration._generate_certbot_conf(
+        # Without long-lived caches, every fragment is rendered and every file
+        # is read to know whether it changed
+        if fragment_cache is None:
+            fragment_cache = plimni.cache.FragmentCache()
+        if digest_cache is None:
+            digest_cache = plimni.cache.DigestCache()
+
+        self._digest_cache = digest_cache
+
+        # The domains are split between `certificate_shards` certificates;
+        # HAProxy serves those Certbot already issued through the crt-list
+        self._certbot_confs = Configuration._generate_certbot_confs(
             services=self._services,
             cluster_domain=cluster_domain,
             cluster_email=cluster_email,
             cluster_branch=cluster_branch,
+            certificate_shards=certificate_shards,
+        )
+        self.https_cert_files = [
+            "{}/live/{}/bundle.pem".format(
+                certbot_conf_folder,
+                Configuration.certificate_name(cluster_domain, shard),
+            )
+            for shard in range(certificate_shards)
+        ]
+        self.https_cert_files = [
+            cert_file for cert_file in self.https_cert_files
+            if os.path.isfile(cert_file)
+        ]
+        self._crt_list_conf = "".join(
+            "{}\n".format(cert_file) for cert_file in self.https_cert_files
+        )
+
+        # Parse the services and generate the configuration files; each one
+        # comes with a key describing what it is generated from, to know
+        # whether it changed without comparing it to the file content
+        self._haproxy_conf, self._haproxy_key, self.haproxy_structure = \
+            Configuration._generate_haproxy_conf(
+                services=self._services,
+                fragment_cache=fragment_cache,
+                server_slots=server_slots,
+                hosts_map_file=self.hosts_map_file,
+                server_state_file=self.server_state_file,
+                crt_list_file=(
+                    self.crt_list_file if self.https_cert_files else ""
+                ),
+                sanitize_conf_folder=self.sanitize_conf_folder,
+                cluster_domain=cluster_domain,
+                cluster_branch=cluster_branch,
+                certbot_url=certbot_url,
+            )
+        self.hosts_map = Configuration._generate_hosts_map(services)
+        self._hosts_map_conf = "".join(
+            "{} {}\n".format(host, backend)
+            for host, backend in sorted(self.hosts_map.items())
         )
+        self._sanitize_confs = Configuration._generate_sanitize_confs(services)
+
+        fragment_cache.rotate()
+
+        if server_slots is not None:
+            server_slots.rotate()
 
     @staticmethod
     def _generate_haproxy_conf(
             services: typing.List[plimni.services.Service],
-            https_cert_file: str,
+            fragment_cache: plimni.cache.FragmentCache,
+            server_slots: plimni.runtime.ServerSlots,
+            hosts_map_file: str,
+            server_state_file: str,
+            crt_list_file: str,
             sanitize_conf_folder: str,
             cluster_domain: str,
             cluster_branch: str,
             certbot_url: str,
-    ) -> str:
-        with open(Configuration.HAPROXY_TEMPLATE, "r") as tmpl:
-            template = jinja2.Template(tmpl.read())
-
-        return template.render(
-            services=services,
-            https_cert_file=("" if not os.path.isfile(https_cert_file)
-                             else https_cert_file),
+    ) -> typing.Tuple[str, tuple, tuple]:
+        """
+        Render the HAProxy configuration and return it along with a key
+        describing what it was rendered from, and a key describing its
+        structure (everything which can't be changed through the Runtime API).
+        """
+        template = plimni.templating.get_template(
+            Configuration.HAPROXY_TEMPLATE,
+        )
+        backend_template = plimni.templating.get_template(
+            Configuration.HAPROXY_BACKEND_TEMPLATE,
+        )
+
+        backends = []
+        fingerprints = []
+        structures = []
+
+        # Each service backend is rendered on its own and only if the service
+        # changed since the last rendering
+        for svc in sorted(services, key=lambda svc: svc.name.lower()):
+            fingerprint = svc.fingerprint()
+
+            slots = None
+            if server_slots is not None:
+                slots = server_slots.assign(
+                    backend=svc.fqdn,
+                    backends=svc.backends,
+                    expose=svc.expose,
+                )
+
+            fingerprints.append((fingerprint, slots))
+            structures.append((
+                tuple(
+                    item for item in fingerprint
+                    if item[0] not in Configuration.RUNTIME_ATTRIBUTES
+                ),
+                len(slots) if slots is not None else fingerprint,
+            ))
+
+            backends.append(fragment_cache.get(
+                (backend_template, fingerprint, slots, sanitize_conf_folder),
+                lambda svc=svc, slots=slots: backend_template.render(
+                    svc=svc,
+                    server_slots=slots,
+                    free_address=plimni.runtime.ServerSlots.FREE_ADDRESS,
+                    sanitize_conf_folder=sanitize_conf_folder,
+                ),
+            ))
+
+        rendered = template.render(
+            backends=backends,
+            hosts_map_file=hosts_map_file,
+            server_state_file=server_state_file,
+            crt_list_file=crt_list_file,
             sanitize_conf_folder=sanitize_conf_folder,
             cluster_domain=cluster_domain,
             cluster_branch=cluster_branch,
             certbot_url=certbot_url,
         )
+        settings = (
+            template, backend_template, hosts_map_file, server_state_file,
+            crt_list_file, sanitize_conf_folder, cluster_domain,
+            cluster_branch, certbot_url,
+        )
+        key = settings + (tuple(fingerprints),)
+        structure = settings + (tuple(structures),)
+
+        return rendered, key, structure
 
     @staticmethod
-    def _generate_sanitize_confs(
+    def _generate_hosts_map(
             services: typing.List[plimni.services.Service],
     ) -> typing.Dict[str, str]:
-        with open(Configuration.SANITIZE_TEMPLATE, "r") as tmpl:
-            template = jinja2.Template(tmpl.read())
+        """Associate each FQDN to the HAProxy backend it is routed to."""
+        hosts = {}
+
+        # If several services answer to the same FQDN, the first one (by
+        # name) gets it
+        for svc in sorted(services, key=lambda svc: svc.name.lower()):
+            if svc.mode not in ("http", "https"):
+                continue
+
+            for fqdn in (svc.fqdn,) + svc.additional_fqdns:
+                hosts.setdefault(fqdn.lower(), svc.fqdn)
+
+        return hosts
+
+    @staticmethod
+    def _generate_sanitize_confs(
+            services: typing.List[plimni.services.Service],
+    ) -> typing.Dict[str, typing.Tuple[str, tuple]]:
+        template = plimni.templating.get_template(
+            Configuration.SANITIZE_TEMPLATE,
+        )
 
         configs = {}
 
@@ -89,56 +234,143 @@ class Configuration():
                 code=svc.http_sanitize_return
             )
 
+            key = (template, svc.http_sanitize_return)
+
             for code in svc.http_sanitize_codes:
-                configs[svc.fqdn + "-" + code] = rendered
+                configs[svc.fqdn + "-" + code] = rendered, key
 
         return configs
 
     @staticmethod
-    def _generate_certbot_conf(
+    def certificate_name(cluster_domain: str, shard: int) -> str:
+        """
+        Return the name of the certificate of the shard `shard`; the first
+        one is named after the cluster domain, as when there was a single
+        certificate.
+        """
+        if shard == 0:
+            return cluster_domain
+
+        return "{}-{}".format(cluster_domain, shard)
+
+    @staticmethod
+    def certificate_shard(svc: plimni.services.Service,
+                          certificate_shards: int) -> int:
+        """
+        Return the shard the certificate of `svc` is in. It only depends on
+        the service FQDN, so services coming and going don't move the others
+        to other certificates.
+        """
+        return zlib.crc32(svc.fqdn.lower().encode("utf-8")) \
+            % certificate_shards
+
+    @staticmethod
+    def _generate_certbot_confs(
             services: typing.List[plimni.services.Service],
             cluster_domain: str,
             cluster_email: str,
             cluster_branch: str,
-    ) -> str:
-        with open(Configuration.CERTBOT_TEMPLATE, "r") as tmpl:
-            template = jinja2.Template(tmpl.read())
-
-        return template.render(
-            services=services,
-            cluster_domain=cluster_domain,
-            cluster_email=cluster_email,
-            cluster_branch=cluster_branch,
+            certificate_shards: int,
+    ) -> typing.Dict[str, typing.Tuple[str, tuple]]:
+        """
+        Render one Certbot configuration per certificate shard, indexed by
+        its file name; shards without any domain have none.
+        """
+        template = plimni.templating.get_template(
+            Configuration.CERTBOT_TEMPLATE,
         )
 
-    @staticmethod
-    def _has_changed(file_path: str, content: str) -> bool:
-        if not os.path.isfile(file_path):
-            if not content:
-                return False
-            return True
+        # shard => (domains, fingerprints of the services); the cluster
+        # domain is always in the first certificate
+        shards = [([], []) for _ in range(certificate_shards)]
+        shards[0][0].append(cluster_domain)
+
+        for svc in services:
+            if svc.mode != "https":
+                continue
 
-        new_hash = hashlib.blake2b(content.encode("utf-8")).hexdigest()
+            domains, fingerprints = shards[
+                Configuration.certificate_shard(svc, certificate_shards)
+            ]
+            domains.append(svc.fqdn)
+            domains.extend(svc.additional_fqdns)
+            fingerprints.append(svc.fingerprint())
 
-        with open(file_path, "r") as file_:
-            old_hash = hashlib\
-                .blake2b(file_.read().encode("utf-8"))\
-                .hexdigest()
+        configs = {}
+
+        for shard, (domains, fingerprints) in enumerate(shards):
+            if not domains:
+                continue
+
+            cert_name = Configuration.certificate_name(cluster_domain, shard)
+
+            if len(domains) > Configuration.CERTIFICATE_MAX_DOMAINS:
+                logger.warning(
+                    "The certificate %s has %d domains, more than the %d "
+                    "allowed; raise the number of certificate shards",
+                    cert_name, len(domains),
+                    Configuration.CERTIFICATE_MAX_DOMAINS,
+                )
+
+            rendered = template.render(
+                cert_name=cert_name,
+                domains=domains,
+                cluster_email=cluster_email,
+            )
+            key = (
+                template, tuple(fingerprints), cert_name, cluster_domain,
+                cluster_email, cluster_branch,
+            )
 
-        return old_hash != new_hash
+            file_name = "cli.ini" if shard == 0 else "cli-{}.ini".format(shard)
+            configs[file_name] = rendered, key
+
+        return configs
+
+    def sizes(self) -> typing.Dict[str, int]:
+        """Return the size of each generated configuration, in bytes."""
+        return {
+            "haproxy": len(self._haproxy_conf),
+            "hosts_map": len(self._hosts_map_conf),
+            "sanitize": sum(
+                len(content) for content, _ in self._sanitize_confs.values()
+            ),
+            "crt_list": len(self._crt_list_conf),
+            "certbot": sum(
+                len(content) for content, _ in self._certbot_confs.values()
+            ),
+        }
 
     def haproxy_changed(self) -> bool:
-        return Configuration._has_changed(
+        return self._digest_cache.has_changed(
             file_path=self.haproxy_conf_file,
             content=self._haproxy_conf,
+            key=self._haproxy_key,
+        )
+
+    def hosts_map_changed(self) -> bool:
+        # HAProxy refuses to start if the map does not exist, even if empty
+        if not os.path.isfile(self.hosts_map_file):
+            return True
+
+        return self._digest_cache.has_changed(
+            file_path=self.hosts_map_file,
+            content=self._hosts_map_conf,
+        )
+
+    def crt_list_changed(self) -> bool:
+        return self._digest_cache.has_changed(
+            file_path=self.crt_list_file,
+            content=self._crt_list_conf,
         )
 
     def sanitize_changed(self) -> bool:
-        for file_name, content in self._sanitize_confs.items():
-            changed = Configuration._has_changed(
+        for file_name, (content, key) in self._sanitize_confs.items():
+            changed = self._digest_cache.has_changed(
                 file_path="{}/{}.html".format(self.sanitize_conf_folder,
                                               file_name),
                 content=content,
+                key=key,
             )
 
             if changed:
@@ -147,21 +379,79 @@ class Configuration():
         return False
 
     def certbot_changed(self) -> bool:
-        return Configuration._has_changed(
-            file_path=self.certbot_conf_file,
-            content=self._certbot_conf,
-        )
+        for file_name, (content, key) in self._certbot_confs.items():
+            changed = self._digest_cache.has_changed(
+                file_path="{}/{}".format(self.certbot_conf_folder, file_name),
+                content=content,
+                key=key,
+            )
+
+            if changed:
+                return True
+
+        # A shard which no longer has any domain
+        return bool(self._stale_certbot_conf_files())
+
+    def _stale_certbot_conf_files(self) -> typing.List[str]:
+        return [
+            file_path for file_path in glob.glob(
+                "{}/cli-*.ini".format(self.certbot_conf_folder),
+            )
+            if os.path.basename(file_path) not in self._certbot_confs
+        ]
 
     def haproxy_write(self):
         with open(self.haproxy_conf_file, "w") as file_:
             file_.write(self._haproxy_conf)
 
+        self._digest_cache.written(
+            file_path=self.haproxy_conf_file,
+            content=self._haproxy_conf,
+            key=self._haproxy_key,
+        )
+
+    def hosts_map_write(self):
+        with open(self.hosts_map_file, "w") as file_:
+            file_.write(self._hosts_map_conf)
+
+        self._digest_cache.written(
+            file_path=self.hosts_map_file,
+            content=self._hosts_map_conf,
+        )
+
+    def crt_list_write(self):
+        with open(self.crt_list_file, "w") as file_:
+            file_.write(self._crt_list_conf)
+
+        self._digest_cache.written(
+            file_path=self.crt_list_file,
+            content=self._crt_list_conf,
+        )
+
     def sanitize_write(self):
-        for name, content in self._sanitize_confs.items():
+        for name, (content, key) in self._sanitize_confs.items():
             file_path = "{}/{}.html".format(self.sanitize_conf_folder, name)
             with open(file_path, "w") as file_:
                 file_.write(content)
 
+            self._digest_cache.written(
+                file_path=file_path,
+                content=content,
+                key=key,
+            )
+
     def certbot_write(self):
-        with open(self.certbot_conf_file, "w") as file_:
-            file_.write(self._certbot_conf)
+        for file_name, (content, key) in self._certbot_confs.items():
+            file_path = "{}/{}".format(self.certbot_conf_folder, file_name)
+            with open(file_path, "w") as file_:
+                file_.write(content)
+
+            self._digest_cache.written(
+                file_path=file_path,
+                content=content,
+                key=key,
+            )
+
+        # Certbot would keep renewing the certificates of these shards
+        for file_path in self._stale_certbot_conf_files():
+            os.remove(file_path)
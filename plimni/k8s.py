@@ -1,113 +1,413 @@
+import logging
+import threading
+import time
+import typing
+
 from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+from kubernetes.watch import Watch
 
+import plimni.metrics
 from plimni.tags import PREFIX, Tags
 from .clients import Client
-from .services import Service
+
+logger = logging.getLogger(__name__)
+
+
+NAMESPACE = "default"
+
+# The label EndpointSlices get the name of their service in
+SERVICE_NAME_LABEL = "kubernetes.io/service-name"
 
 
 class KubernetesClient(Client):
-    def __init__(self, instance: client):
+    # How long a watch request is kept open before being renewed (seconds)
+    WATCH_TIMEOUT = 300
+    # How long to wait before watching again after an unexpected error
+    WATCH_RETRY_DELAY = 5
+    # How many objects to retrieve per list request
+    LIST_LIMIT = 500
+
+    def __init__(self, instance: client, watch: bool = False,
+                 discovery: client.DiscoveryV1Api = None,
+                 namespace: str = NAMESPACE):
+        super().__init__()
         self._instance = instance
+        self._watch = watch
+        self._namespace = namespace
+
+        # With the discovery API, backends are read from EndpointSlices
+        # instead of Endpoints: a pod change then only updates its slice
+        # instead of the Endpoints object of the whole service
+        self._discovery = discovery
+
+        if discovery is None:
+            self._endpoints_kind = "endpoints"
+            self._list_endpoints = self._instance.list_namespaced_endpoints
+        else:
+            self._endpoints_kind = "endpointslices"
+            self._list_endpoints = discovery.list_namespaced_endpoint_slice
+
+        # In watch mode, Services (indexed by name) and Endpoints or
+        # EndpointSlices (indexed by service name, then by their own name) are
+        # kept in memory and kept up to date by the watch threads
+        self._lock = threading.Lock()
+        self._services = {}
+        self._endpoints = {}
+        self._watching = False
 
     def get_services(self, cluster_branch: str, cluster_domain: str):
-        services = self._instance.list_namespaced_service(namespace="default")
+        if self._watch:
+            self._start_watching()
+            with self._lock:
+                services = list(self._services.values())
+        else:
+            # Retrieve all the endpoints at once instead of one request per
+            # service
+            services, _ = self._list(self._instance.list_namespaced_service)
+            endpoints, _ = self._list(self._list_endpoints)
+            endpoints = KubernetesClient._index(self._endpoints_kind,
+                                                endpoints)
 
-        print("Retrieving services on Kubernetes...")
+        logger.debug("Retrieving services on Kubernetes...")
 
         services_computed = []
+        invalid = {}
 
         # Filter the services
-        for service in services.items:
+        for service in services:
             service_name = service.metadata.name
             annotations = service.metadata.annotations
 
-            print("Processing service {}...".format(service_name))
+            logger.debug("Processing service %s...", service_name)
 
             if annotations is None:
-                print("=> no annotation, skipping it")
+                plimni.metrics.SERVICES_SKIPPED.inc()
+                logger.debug("=> no annotation, skipping it")
                 continue
 
             # Skip if there is no Plimni-specific annotation
-            if not any(
-                    key.startswith(PREFIX) for key in annotations.keys()
-            ):
-                print("=> no {} annotation, skipping it".format(PREFIX))
+            if not KubernetesClient._is_annotated(service):
+                plimni.metrics.SERVICES_SKIPPED.inc()
+                logger.debug("=> no %s annotation, skipping it", PREFIX)
                 continue
 
-            s_expose = annotations.get(Tags.EXPOSE)
-            s_name = annotations.get(Tags.NAME)
-            s_branch = annotations.get(Tags.BRANCH)
-            s_fqdn = annotations.get(Tags.FQDN)
-            s_additional_fqdns = annotations.get(Tags.ADDITIONAL_FQDNS)
-            if s_additional_fqdns is not None:
-                s_additional_fqdns = s_additional_fqdns.split(",")
-            s_mode = annotations.get(Tags.MODE)
-            s_http_port = annotations.get(Tags.HTTP_PORT)
-            s_https_port = annotations.get(Tags.HTTPS_PORT)
-            s_http_sanitize_codes = annotations.get(Tags.HTTP_SANITIZE_CODES)
-            if s_http_sanitize_codes is not None:
-                s_http_sanitize_codes = s_http_sanitize_codes.split(",")
-            s_http_sanitize_return = annotations.get(Tags.HTTP_SANITIZE_RETURN)
-
-            # If no annotation is defined for the name, use the service name
-            if not s_name:
-                s_name = service_name
-
             # Retrieve backends
-            print("Annotations processed, retrieving endpoints...")
+            logger.debug("Annotations processed, retrieving endpoints...")
 
-            endpoint = self._instance.read_namespaced_endpoints(
-                name=service_name,
-                namespace="default",
-            )
-
-            s_backends = []
-
-            if endpoint.subsets is not None:
-                # XXX this might cause issues in the future if we have
-                # multiple subsets but it's not well understood as of now
-                subset = endpoint.subsets[0]
+            if self._watch:
+                with self._lock:
+                    objects = list(
+                        self._endpoints.get(service_name, {}).values()
+                    )
+            else:
+                objects = endpoints.get(service_name, {}).values()
 
-                # XXX same as above but if we have multiple ports for a service
-                port = subset.ports[0].port
+            s_backends = KubernetesClient._backends(
+                objects, annotations.get(Tags.PORT_NAME),
+            )
 
-                if subset.addresses:
-                    for addr in subset.addresses:
-                        ip_addr = addr.ip
-                        print("Adding backend {}:{}".format(ip_addr, port))
-                        s_backends.append((ip_addr, port))
+            if logger.isEnabledFor(logging.DEBUG):
+                for ip_addr, port in s_backends:
+                    logger.debug("Adding backend %s:%s", ip_addr, port)
 
             plimni_service = None
 
             try:
-                plimni_service = Service(
+                plimni_service = self._factory.build(
+                    name=service_name,
+                    settings=annotations,
+                    backends=s_backends,
                     cluster_branch=cluster_branch,
                     cluster_domain=cluster_domain,
-                    expose=s_expose,
-                    name=s_name,
-                    branch=s_branch,
-                    fqdn=s_fqdn,
-                    additional_fqdns=s_additional_fqdns,
-                    mode=s_mode,
-                    http_port=s_http_port,
-                    https_port=s_https_port,
-                    http_sanitize_codes=s_http_sanitize_codes,
-                    http_sanitize_return=s_http_sanitize_return,
-                    backends=s_backends,
                 )
             except ValueError as err:
-                print("Can't process service {} because of: {}"
-                      "".format(service_name, str(err)))
+                plimni.metrics.SERVICES_INVALID.inc()
+                invalid[service_name] = str(err)
                 continue
 
+            plimni.metrics.SERVICES_PROCESSED.inc()
             services_computed.append(plimni_service)
 
+        self._factory.rotate()
+        self._report_invalid(invalid)
+
         return services_computed
 
     def get_certbot_url(self, private_ip: str) -> str:
         return "certbot"
 
+    def _list(self, list_func) -> typing.Tuple[list, str]:
+        """
+        Retrieve all the objects of a kind, `LIST_LIMIT` at a time, and return
+        them along with the resource version of the listing.
+        """
+        items = []
+        continue_ = None
+
+        while True:
+            result = list_func(
+                namespace=self._namespace,
+                limit=KubernetesClient.LIST_LIMIT,
+                _continue=continue_,
+            )
+            items.extend(result.items)
+            continue_ = result.metadata._continue
+
+            if not continue_:
+                return items, result.metadata.resource_version
+
+    @staticmethod
+    def _is_annotated(service) -> bool:
+        annotations = service.metadata.annotations
+
+        if annotations is None:
+            return False
+
+        return any(key.startswith(PREFIX) for key in annotations.keys())
+
+    @staticmethod
+    def _owner(kind: str, obj) -> str:
+        """Return the name of the service `obj` (of the kind `kind`) is for."""
+        if kind == "endpointslices":
+            return (obj.metadata.labels or {}).get(SERVICE_NAME_LABEL)
+
+        return obj.metadata.name
+
+    @staticmethod
+    def _index(kind: str, items: list) -> typing.Dict[str, dict]:
+        """
+        Index the Endpoints or EndpointSlices `items` by the name of their
+        service, then by their own name.
+        """
+        index = {}
+
+        for item in items:
+            owner = KubernetesClient._owner(kind, item)
+
+            if owner is not None:
+                index.setdefault(owner, {})[item.metadata.name] = item
+
+        return index
+
+    @staticmethod
+    def _port(ports: list, port_name: str) -> int:
+        """
+        Return the port named `port_name`, or the first one if no name is
+        given, or `None` if there is no such port.
+        """
+        for port in ports or []:
+            if port_name is None or port.name == port_name:
+                return port.port
+
+        return None
+
+    @staticmethod
+    def _backends(objects: typing.Iterable, port_name: str = None) -> list:
+        """
+        Return the ready (ip, port) of the Endpoints or EndpointSlices
+        `objects` of a service, on the port `port_name`.
+        """
+        # An address can be in several slices while they are being updated
+        backends = {}
+
+        for obj in objects:
+            if isinstance(obj, client.V1Endpoints):
+                for subset in obj.subsets or []:
+                    port = KubernetesClient._port(subset.ports, port_name)
+
+                    if port is None:
+                        continue
+
+                    # Addresses which are not ready are in
+                    # `not_ready_addresses`
+                    for addr in subset.addresses or []:
+                        backends[(addr.ip, port)] = None
+            else:
+                port = KubernetesClient._port(obj.ports, port_name)
+
+                if port is None:
+                    continue
+
+                for endpoint in obj.endpoints or []:
+                    # An unknown readiness must be taken as ready
+                    if endpoint.conditions is not None \
+                            and endpoint.conditions.ready is False:
+                        continue
+
+                    for address in endpoint.addresses:
+                        backends[(address, port)] = None
+
+        return list(backends)
+
+    def _exposed_state(self, name: str):
+        """
+        Return what Plimni cares about for the service `name` (its Plimni
+        annotations and its backends), or `None` if it is not exposed.
+        Must be called with the lock held.
+        """
+        service = self._services.get(name)
+
+        if service is None or not KubernetesClient._is_annotated(service):
+            return None
+
+        annotations = tuple(sorted(
+            (key, value)
+            for key, value in service.metadata.annotations.items()
+            if key.startswith(PREFIX)
+        ))
+        backends = tuple(KubernetesClient._backends(
+            self._endpoints.get(name, {}).values(),
+            service.metadata.annotations.get(Tags.PORT_NAME),
+        ))
+
+        return annotations, backends
+
+    def _start_watching(self):
+        if self._watching:
+            return
+
+        logger.info("Listing services and %s before watching them...",
+                    self._endpoints_kind)
+
+        watched = []
+
+        for kind, list_func in (
+                ("services", self._instance.list_namespaced_service),
+                (self._endpoints_kind, self._list_endpoints),
+        ):
+            # The services are about to be built from this initial listing,
+            # there is no need to wake the main loop up for it (and the
+            # change event may be shared with other clients, it can't be
+            # cleared)
+            resource_version = self._resync(kind, list_func, notify=False)
+            watched.append((kind, list_func, resource_version))
+
+        for kind, list_func, resource_version in watched:
+            thread = threading.Thread(
+                target=self._watch_loop,
+                args=(kind, list_func, resource_version),
+                name="plimni-watch-{}".format(kind),
+                daemon=True,
+            )
+            thread.start()
+
+        self._watching = True
+
+    def _resync(self, kind: str, list_func, notify: bool = True) -> str:
+        """
+        List all the objects of a kind, replace the cache content with them
+        and return the resource version the watch has to resume from. The
+        main loop is woken up if an exposed service changed and `notify` is
+        set.
+        """
+        items, resource_version = self._list(list_func)
+
+        if kind == "services":
+            attribute = "_services"
+            cache = {item.metadata.name: item for item in items}
+        else:
+            attribute = "_endpoints"
+            cache = KubernetesClient._index(kind, items)
+
+        with self._lock:
+            names = set(getattr(self, attribute).keys()) | set(cache.keys())
+            before = {name: self._exposed_state(name) for name in names}
+
+            setattr(self, attribute, cache)
+
+            changed = any(
+                before[name] != self._exposed_state(name) for name in names
+            )
+
+        if changed and notify:
+            self.notify_change()
+
+        return resource_version
+
+    def _apply_event(self, kind: str, event_type: str, obj):
+        name = KubernetesClient._owner(kind, obj)
+
+        if name is None:
+            return
+
+        with self._lock:
+            before = self._exposed_state(name)
+
+            if kind == "services":
+                if event_type == "DELETED":
+                    self._services.pop(name, None)
+                else:
+                    self._services[name] = obj
+            else:
+                objects = self._endpoints.setdefault(name, {})
+
+                if event_type == "DELETED":
+                    objects.pop(obj.metadata.name, None)
+                else:
+                    objects[obj.metadata.name] = obj
+
+                if not objects:
+                    del self._endpoints[name]
+
+            after = self._exposed_state(name)
+
+        if before != after:
+            logger.info("Service %s changed", name)
+            self.notify_change()
+
+    def _watch_loop(self, kind: str, list_func, resource_version: str):
+        while True:
+            try:
+                if resource_version is None:
+                    resource_version = self._resync(kind, list_func)
+
+                stream = Watch().stream(
+                    list_func,
+                    namespace=self._namespace,
+                    resource_version=resource_version,
+                    timeout_seconds=KubernetesClient.WATCH_TIMEOUT,
+                )
+
+                for event in stream:
+                    if event["type"] == "ERROR":
+                        # Most likely a 410 Gone: our resource version is too
+                        # old, we have to list everything again
+                        logger.warning("Watch on %s failed, listing them "
+                                       "again", kind)
+                        resource_version = None
+                        break
+
+                    obj = event["object"]
+                    resource_version = obj.metadata.resource_version
+                    self._apply_event(kind, event["type"], obj)
+            except ApiException as exc:
+                if exc.status == 410:
+                    logger.info("Resource version of %s expired, listing "
+                                "them again", kind)
+                    resource_version = None
+                else:
+                    logger.error("Error when watching %s: %s", kind, exc)
+                    time.sleep(KubernetesClient.WATCH_RETRY_DELAY)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Error when watching %s: %s", kind, exc)
+                time.sleep(KubernetesClient.WATCH_RETRY_DELAY)
+
+
+def get_client(watch: bool = False, endpoint_slices: bool = False,
+               namespace: str = NAMESPACE, context: str = None) -> Client:
+    if context is None:
+        config.load_incluster_config()
+        api_client = None
+    else:
+        # Another cluster, from the kubeconfig file
+        api_client = config.new_client_from_config(context=context)
 
-def get_client() -> Client:
-    config.load_incluster_config()
-    return KubernetesClient(client.CoreV1Api())
+    return KubernetesClient(
+        client.CoreV1Api(api_client),
+        watch=watch,
+        discovery=(
+            client.DiscoveryV1Api(api_client) if endpoint_slices else None
+        ),
+        namespace=namespace,
+    )
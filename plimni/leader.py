@@ -0,0 +1,483 @@
+import base64
+import datetime
+import fcntl
+import logging
+import os
+import time
+import typing
+
+import consul
+from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+
+import plimni.snapshot
+from .services import Service
+
+logger = logging.getLogger(__name__)
+
+STORES = ["consul", "k8s", "file"]
+
+# Where Kubernetes tells pods which namespace they run in
+NAMESPACE_FILE = "/var/run/secrets/kubernetes.io/serviceaccount/namespace"
+
+# Published instead of the snapshot when the leader can't publish it, for the
+# followers to retrieve the services themselves
+PUBLISH_FAILED = b"publish-failed"
+
+
+class Store():
+    """
+    Where the Plimni instances elect their leader and where the leader
+    publishes its services for the other instances (the followers).
+    """
+    # The biggest snapshot the store accepts, in bytes (`None` if unlimited)
+    MAX_SIZE = None
+
+    def acquire(self, identity: str, ttl: float) -> bool:
+        """
+        Take or keep the leadership for `ttl` seconds and return whether
+        `identity` is the leader.
+        """
+        raise NotImplementedError()
+
+    def publish(self, data: bytes):
+        """Publish a new snapshot of the services."""
+        raise NotImplementedError()
+
+    def fetch(self, version: str) -> typing.Tuple[str, bytes]:
+        """
+        Return the version of the published snapshot along with its data, or
+        with `None` if it is still `version`; return `(None, None)` if
+        nothing was published yet.
+        """
+        raise NotImplementedError()
+
+
+class ConsulStore(Store):
+    """
+    Elect the leader with a Consul lock (a KV entry acquired by a session)
+    and publish the snapshot in the Consul KV store.
+
+    Args:
+        instance (Consul): The Consul client.
+        key (str): The prefix of the KV entries.
+    """
+    # Consul refuses KV values bigger than 512 KB
+    MAX_SIZE = 512 * 1024
+
+    def __init__(self, instance, key: str):
+        self._instance = instance
+        self._lock_key = "{}/leader".format(key)
+        self._snapshot_key = "{}/snapshot".format(key)
+        self._session = None
+
+    def acquire(self, identity: str, ttl: float) -> bool:
+        # The session is invalidated, and the lock released, if it is not
+        # renewed within its TTL
+        if self._session is not None:
+            try:
+                self._instance.session.renew(self._session)
+            except consul.NotFound:
+                self._session = None
+
+        if self._session is None:
+            self._session = self._instance.session.create(
+                name="plimni-{}".format(identity),
+                ttl=max(int(ttl), 10),
+                behavior="release",
+                lock_delay=0,
+            )
+
+        return self._instance.kv.put(self._lock_key, identity,
+                                     acquire=self._session)
+
+    def publish(self, data: bytes):
+        self._instance.kv.put(self._snapshot_key, data)
+
+    def fetch(self, version: str) -> typing.Tuple[str, bytes]:
+        _, entry = self._instance.kv.get(self._snapshot_key)
+
+        if entry is None:
+            return None, None
+
+        new_version = str(entry["ModifyIndex"])
+
+        if new_version == version:
+            return version, None
+
+        return new_version, entry["Value"]
+
+
+class KubernetesStore(Store):
+    """
+    Elect the leader with a Lease and publish the snapshot in a ConfigMap,
+    both named after `key`, in the namespace Plimni runs in.
+
+    Args:
+        core (CoreV1Api): The client of the Kubernetes core API.
+        coordination (CoordinationV1Api): The client of the Kubernetes
+                                          coordination API.
+        namespace (str): The namespace of the Lease and the ConfigMap.
+        key (str): The prefix of their names.
+    """
+    SNAPSHOT_KEY = "snapshot"
+    # ConfigMaps can't exceed 1 MB, and the snapshot is base64 encoded in it
+    MAX_SIZE = 750 * 1024
+
+    def __init__(self, core, coordination, namespace: str, key: str):
+        self._core = core
+        self._coordination = coordination
+        self._namespace = namespace
+        self._lease_name = "{}-leader".format(key)
+        self._config_map_name = "{}-snapshot".format(key)
+
+    @staticmethod
+    def _now() -> str:
+        # The format of the MicroTime of the Kubernetes API
+        return datetime.datetime.now(datetime.timezone.utc).strftime(
+            "%Y-%m-%dT%H:%M:%S.%fZ",
+        )
+
+    def acquire(self, identity: str, ttl: float) -> bool:
+        try:
+            lease = self._coordination.read_namespaced_lease(
+                self._lease_name, self._namespace,
+            )
+        except ApiException as exc:
+            if exc.status != 404:
+                raise
+            lease = None
+
+        if lease is None:
+            lease = client.V1Lease(
+                metadata=client.V1ObjectMeta(name=self._lease_name),
+                spec=client.V1LeaseSpec(
+                    holder_identity=identity,
+                    lease_duration_seconds=int(ttl),
+                    acquire_time=KubernetesStore._now(),
+                    renew_time=KubernetesStore._now(),
+                ),
+            )
+
+            try:
+                self._coordination.create_namespaced_lease(self._namespace,
+                                                           lease)
+            except ApiException as exc:
+                # Another instance created it first
+                if exc.status == 409:
+                    return False
+                raise
+
+            return True
+
+        spec = lease.spec
+
+        if spec.holder_identity != identity:
+            expires = None
+            if spec.renew_time is not None:
+                expires = spec.renew_time + datetime.timedelta(
+                    seconds=spec.lease_duration_seconds or 0,
+                )
+
+            if expires is not None and expires > datetime.datetime.now(
+                    datetime.timezone.utc):
+                return False
+
+            spec.holder_identity = identity
+            spec.acquire_time = KubernetesStore._now()
+            spec.lease_transitions = (spec.lease_transitions or 0) + 1
+
+        spec.renew_time = KubernetesStore._now()
+        spec.lease_duration_seconds = int(ttl)
+
+        # The Lease holds its resource version: the update fails if another
+        # instance updated it in the meantime
+        try:
+            self._coordination.replace_namespaced_lease(
+                self._lease_name, self._namespace, lease,
+            )
+        except ApiException as exc:
+            if exc.status == 409:
+                return False
+            raise
+
+        return True
+
+    def publish(self, data: bytes):
+        config_map = client.V1ConfigMap(
+            metadata=client.V1ObjectMeta(name=self._config_map_name),
+            binary_data={
+                KubernetesStore.SNAPSHOT_KEY:
+                    base64.b64encode(data).decode("ascii"),
+            },
+        )
+
+        try:
+            self._core.replace_namespaced_config_map(
+                self._config_map_name, self._namespace, config_map,
+            )
+        except ApiException as exc:
+            if exc.status != 404:
+                raise
+            self._core.create_namespaced_config_map(self._namespace,
+                                                    config_map)
+
+    def fetch(self, version: str) -> typing.Tuple[str, bytes]:
+        try:
+            config_map = self._core.read_namespaced_config_map(
+                self._config_map_name, self._namespace,
+            )
+        except ApiException as exc:
+            if exc.status == 404:
+                return None, None
+            raise
+
+        new_version = config_map.metadata.resource_version
+
+        if new_version == version:
+            return version, None
+
+        return new_version, base64.b64decode(
+            (config_map.binary_data or {})[KubernetesStore.SNAPSHOT_KEY],
+        )
+
+
+class FileStore(Store):
+    """
+    Elect the leader with a lock file and publish the snapshot in a file,
+    both in the folder `key`, for instances sharing a volume.
+
+    Args:
+        key (str): The folder of the lock and the snapshot.
+    """
+    def __init__(self, key: str):
+        self._lock_file = os.path.join(key, "leader")
+        self._snapshot_file = os.path.join(key, "snapshot")
+
+    def acquire(self, identity: str, ttl: float) -> bool:
+        with open(self._lock_file, "a+") as file_:
+            # The lock file holds the leader and when its leadership expires
+            fcntl.flock(file_, fcntl.LOCK_EX)
+            file_.seek(0)
+            leader, _, expires = file_.read().partition(" ")
+            now = time.time()
+
+            if leader and leader != identity and float(expires) > now:
+                return False
+
+            file_.seek(0)
+            file_.truncate()
+            file_.write("{} {}".format(identity, now + ttl))
+
+        return True
+
+    def publish(self, data: bytes):
+        with open(self._snapshot_file + ".tmp", "wb") as file_:
+            file_.write(data)
+
+        os.rename(self._snapshot_file + ".tmp", self._snapshot_file)
+
+    def fetch(self, version: str) -> typing.Tuple[str, bytes]:
+        try:
+            stat = os.stat(self._snapshot_file)
+        except FileNotFoundError:
+            return None, None
+
+        new_version = "{}-{}".format(stat.st_ino, stat.st_mtime_ns)
+
+        if new_version == version:
+            return version, None
+
+        with open(self._snapshot_file, "rb") as file_:
+            return new_version, file_.read()
+
+
+class Election():
+    """
+    Elect a leader among the Plimni instances sharing `store`: only the
+    leader retrieves the services from the orchestrator, and publishes them
+    as a snapshot the followers generate their configuration from.
+
+    If the store can't be reached, every instance retrieves the services
+    itself, as without election.
+
+    Args:
+        store (Store): Where the leader is elected and the snapshot
+                       published.
+        identity (str): The name of this instance, unique among them.
+        ttl (float): How long the leadership lasts without being renewed, in
+                     seconds.
+        cluster_branch (str): The main branch this cluster operates on.
+        cluster_domain (str): The domain of this cluster.
+    """
+    def __init__(self, store: Store, identity: str, ttl: float,
+                 cluster_branch: str, cluster_domain: str):
+        self._store = store
+        self.identity = identity
+        self.ttl = ttl
+        self._cluster_branch = cluster_branch
+        self._cluster_domain = cluster_domain
+
+        self.leader = None
+
+        # The fingerprints of the services published as the leader, and the
+        # version of the snapshot applied as a follower
+        self._published = None
+        self._version = None
+
+        # Whether, as a follower, there is no usable snapshot of the leader
+        # (nothing published, the leader can't publish or the store can't be
+        # reached): the services must then be retrieved without election
+        self.fallback = True
+
+    def is_leader(self) -> bool:
+        """Take or keep the leadership and return whether it is ours."""
+        try:
+            leader = self._store.acquire(self.identity, self.ttl)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Error when electing the leader, retrieving the "
+                           "services without election: %s", exc)
+            return True
+
+        if leader != self.leader:
+            if leader:
+                logger.info("%s is now the leader", self.identity)
+            else:
+                logger.info("%s is now a follower", self.identity)
+
+            self._published = None
+            self._version = None
+            self.fallback = True
+
+        self.leader = leader
+
+        return leader
+
+    def publish(self, services: typing.List[Service]):
+        """Publish `services` if they changed since the last publication."""
+        fingerprints = tuple(svc.fingerprint() for svc in services)
+
+        if fingerprints == self._published:
+            return
+
+        data = plimni.snapshot.dumps(
+            services=services,
+            cluster_branch=self._cluster_branch,
+            cluster_domain=self._cluster_domain,
+        )
+
+        max_size = self._store.MAX_SIZE
+
+        if max_size is not None and len(data) > max_size:
+            logger.error("The snapshot of %d services is %d bytes, more than "
+                         "the %d bytes the store accepts: the followers "
+                         "retrieve the services themselves", len(services),
+                         len(data), max_size)
+            # It is not tried again until the services change
+            if self._publish_failed():
+                self._published = fingerprints
+            return
+
+        try:
+            self._store.publish(data)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Error when publishing the services, the "
+                           "followers retrieve them themselves: %s", exc)
+            self._publish_failed()
+            return
+
+        logger.info("Published %d services (%d bytes)", len(services),
+                    len(data))
+        self._published = fingerprints
+
+    def _publish_failed(self) -> bool:
+        """
+        Tell the followers the snapshot could not be published, so they
+        don't keep the previous one; return whether they were told.
+        """
+        try:
+            self._store.publish(PUBLISH_FAILED)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Error when telling the followers the services "
+                           "could not be published: %s", exc)
+            return False
+
+        return True
+
+    def fetch(self) -> typing.List[Service]:
+        """
+        Return the services published by the leader, or `None` if they did
+        not change since the last call or if there is no usable snapshot
+        (see `fallback`).
+        """
+        try:
+            version, data = self._store.fetch(self._version)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Error when fetching the services of the leader, "
+                           "retrieving them without election: %s", exc)
+            self.fallback = True
+            return None
+
+        if version is None:
+            # Nothing published yet
+            self.fallback = True
+            return None
+
+        if data is None:
+            return None
+
+        # An unusable snapshot is not read again until the leader publishes
+        # a new one
+        self._version = version
+
+        if data == PUBLISH_FAILED:
+            logger.warning("The leader could not publish the services, "
+                           "retrieving them without election")
+            self.fallback = True
+            return None
+
+        services = plimni.snapshot.loads(
+            data=data,
+            origin="of the leader",
+            max_age=None,
+            cluster_branch=self._cluster_branch,
+            cluster_domain=self._cluster_domain,
+        )
+
+        if services is not None:
+            logger.info("Fetched the version %s of the services of the "
+                        "leader", version)
+
+        self.fallback = services is None
+
+        return services
+
+
+def get_store(name: str, key: str, consul_host: str = "127.0.0.1",
+              consul_port: int = 8500, consul_datacenter: str = None,
+              consul_timeout: float = 10) -> Store:
+    if name == "consul":
+        from . import nomad
+        return ConsulStore(
+            nomad.ConsulClient(timeout=consul_timeout, pool_size=1,
+                               host=consul_host, port=consul_port,
+                               dc=consul_datacenter),
+            key=key,
+        )
+    if name == "k8s":
+        config.load_incluster_config()
+
+        with open(NAMESPACE_FILE) as file_:
+            namespace = file_.read().strip()
+
+        return KubernetesStore(
+            client.CoreV1Api(),
+            client.CoordinationV1Api(),
+            namespace=namespace,
+            key=key,
+        )
+    if name == "file":
+        return FileStore(key)
+    else:
+        raise NotImplementedError("The leader election store {} is not "
+                                  "implemented".format(name))
@@ -0,0 +1,54 @@
+import json
+import logging
+import sys
+
+LEVELS = ["debug", "info", "warning", "error"]
+FORMATS = ["text", "json"]
+
+# The attributes every log record has, anything else was given through
+# `extra` and is added to the JSON output
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord(
+    name="", level=0, pathname="", lineno=0, msg="", args=(), exc_info=None,
+))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    """Format each record as a JSON object on a single line."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+def setup(level: str = "info", format_: str = "text"):
+    """Send the logs of Plimni to stdout, with the given level and format."""
+    if level not in LEVELS:
+        raise ValueError("Unknown log level {}".format(level))
+    if format_ not in FORMATS:
+        raise ValueError("Unknown log format {}".format(format_))
+
+    handler = logging.StreamHandler(sys.stdout)
+
+    if format_ == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s: %(message)s",
+        ))
+
+    logger = logging.getLogger("plimni")
+    logger.addHandler(handler)
+    logger.setLevel(level.upper())
+    logger.propagate = False
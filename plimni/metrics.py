@@ -0,0 +1,65 @@
+import prometheus_client
+
+# The metrics are always collected, they are only exposed if the listener is
+# started
+DISCOVERY_SECONDS = prometheus_client.Histogram(
+    "plimni_discovery_seconds",
+    "Time spent retrieving the services from the orchestrator",
+)
+RENDER_SECONDS = prometheus_client.Histogram(
+    "plimni_render_seconds",
+    "Time spent rendering the configurations",
+)
+WRITE_SECONDS = prometheus_client.Histogram(
+    "plimni_write_seconds",
+    "Time spent checking and writing the changed configurations",
+)
+
+SERVICES_PROCESSED = prometheus_client.Counter(
+    "plimni_services_processed_total",
+    "Services retrieved from the orchestrator and turned into Plimni services",
+)
+SERVICES_SKIPPED = prometheus_client.Counter(
+    "plimni_services_skipped_total",
+    "Services retrieved from the orchestrator without Plimni settings",
+)
+SERVICES_INVALID = prometheus_client.Counter(
+    "plimni_services_invalid_total",
+    "Services retrieved from the orchestrator with invalid Plimni settings",
+)
+
+RELOADS = prometheus_client.Counter(
+    "plimni_reloads_total",
+    "HAProxy reloads sent",
+)
+RELOAD_FAILURES = prometheus_client.Counter(
+    "plimni_reload_failures_total",
+    "HAProxy reloads which could not be sent",
+)
+RELOADS_AVOIDED = prometheus_client.Counter(
+    "plimni_reloads_avoided_total",
+    "HAProxy reloads merged into another reload",
+)
+CERTIFICATES_UPDATED = prometheus_client.Counter(
+    "plimni_certificates_updated_total",
+    "Certificates sent to HAProxy through the Runtime API",
+)
+
+EXPOSED_SERVICES = prometheus_client.Gauge(
+    "plimni_exposed_services",
+    "Services currently exposed",
+)
+BACKENDS = prometheus_client.Gauge(
+    "plimni_backends",
+    "Backends of the services currently exposed",
+)
+CONFIG_SIZE = prometheus_client.Gauge(
+    "plimni_config_size_bytes",
+    "Size of the generated configurations",
+    ["file"],
+)
+
+
+def start(port: int, address: str = ""):
+    """Expose the metrics over HTTP on `address`:`port`."""
+    prometheus_client.start_http_server(port, addr=address)
@@ -1,104 +1,449 @@
+import concurrent.futures
+import logging
+import threading
+import time
+import typing
+
+import consul.std
+import requests.adapters
 from consul import Consul
 
-from plimni.tags import PREFIX, Tags
+import plimni.metrics
+from plimni.tags import PREFIX
 from .clients import Client
-from .services import Service
+
+logger = logging.getLogger(__name__)
+
+
+class ConsulHTTPClient(consul.std.HTTPClient):
+    """
+    The python-consul HTTP client, with a connection pool big enough for
+    concurrent requests and a timeout on every request.
+
+    Args:
+        timeout (float): How long to wait for Consul to answer, in seconds.
+                         Blocking queries are given their `wait` time on top
+                         of it.
+        pool_size (int): How many keep-alive connections to Consul to keep.
+    """
+    def __init__(self, *args, timeout: float, pool_size: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = timeout
+
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _timeout(self, params) -> float:
+        for key, value in params or []:
+            if key == "wait":
+                unit = {"s": 1, "m": 60}[value[-1]]
+                return self.timeout + int(value[:-1]) * unit
+
+        return self.timeout
+
+    def get(self, callback, path, params=None):
+        uri = self.uri(path, params)
+        return callback(self.response(
+            self.session.get(uri, verify=self.verify, cert=self.cert,
+                             timeout=self._timeout(params))))
+
+
+class ConsulClient(Consul):
+    """A Consul client using `ConsulHTTPClient`."""
+    def __init__(self, timeout: float, pool_size: int, **kwargs):
+        self._timeout = timeout
+        self._pool_size = pool_size
+        super().__init__(**kwargs)
+
+    def connect(self, host, port, scheme, verify=True, cert=None):
+        return ConsulHTTPClient(host, port, scheme, verify, cert,
+                                timeout=self._timeout,
+                                pool_size=self._pool_size)
 
 
 class NomadClient(Client):
-    def __init__(self, instance: Consul):
+    # How long a blocking query waits for a change before returning
+    WATCH_WAIT = "5m"
+    # How long to wait before querying again after an unexpected error
+    WATCH_RETRY_DELAY = 5
+    # The highest weight HAProxy accepts (Consul accepts higher ones)
+    MAX_WEIGHT = 256
+
+    def __init__(self, instance: Consul, watch: bool = False,
+                 concurrency: int = 1, health: bool = False):
+        super().__init__()
         self._instance = instance
+        self._watch = watch
+
+        # In health mode, the endpoints come from the health API: only the
+        # instances passing their checks are returned, with their weights
+        self._health = health
+
+        # The endpoints of the services are retrieved concurrently, with at
+        # most `concurrency` requests in flight
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency,
+            thread_name_prefix="plimni-consul",
+        )
+
+        # In watch mode, the catalog (service name => tags) and the endpoints
+        # of the Plimni services are kept in memory and kept up to date by 2
+        # blocking queries: one on the catalog and one on the health checks.
+        # The checks tell which services changed (an instance registered or
+        # deregistered, a check changing of status): only their endpoints
+        # are fetched again. Services with instances without checks can't be
+        # told apart this way, they are fetched again whenever the catalog
+        # changes
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._catalog = {}
+        self._endpoints = {}
+        self._indexes = {}
+        # service name => its checks (with the checks of its nodes)
+        self._checks = {}
+        # The Plimni services with instances without checks
+        self._unchecked = set()
+        self._watching = False
 
     def get_services(self, cluster_branch: str, cluster_domain: str):
-        _, services = self._instance.catalog.services()
+        if self._watch:
+            self._start_watching()
+            with self._lock:
+                services = dict(self._catalog)
+        else:
+            _, services = self._instance.catalog.services()
 
-        print("Retrieving services on Consul...")
+        logger.debug("Retrieving services on Consul...")
 
-        services_computed = []
+        services_tagged = {}
 
         # Filter the services
         for service_name, service_tags in services.items():
-            print("Processing service {}...".format(service_name))
+            logger.debug("Processing service %s...", service_name)
 
             if not service_tags:
-                print("=> no tags, skipping it")
+                plimni.metrics.SERVICES_SKIPPED.inc()
+                logger.debug("=> no tags, skipping it")
                 continue
 
             # Skip if there is no Plimni-specific annotation
-            if not any(
-                    key.startswith(PREFIX) for key in service_tags
-            ):
-                print("=> no {} tags, skipping it".format(PREFIX))
+            if not NomadClient._is_tagged(service_tags):
+                plimni.metrics.SERVICES_SKIPPED.inc()
+                logger.debug("=> no %s tags, skipping it", PREFIX)
                 continue
 
-            tags = {
-                key: value
-                for key, value in
-                map(
-                    lambda e: e.split("="),
-                    filter(lambda e: e.startswith(PREFIX), service_tags)
-                )
+            services_tagged[service_name] = service_tags
+
+        # Retrieve backends
+        logger.debug("Tags processed, retrieving endpoints...")
+
+        if self._watch:
+            with self._lock:
+                services_endpoints = {
+                    name: self._endpoints.get(name, [])
+                    for name in services_tagged
+                }
+        else:
+            services_endpoints = {
+                name: endpoints for name, (_, endpoints)
+                in self._fetch_endpoints(services_tagged).items()
             }
 
-            s_expose = tags.get(Tags.EXPOSE)
-            s_name = tags.get(Tags.NAME)
-            s_branch = tags.get(Tags.BRANCH)
-            s_fqdn = tags.get(Tags.FQDN)
-            s_additional_fqdns = tags.get(Tags.ADDITIONAL_FQDNS)
-            if s_additional_fqdns is not None:
-                s_additional_fqdns = s_additional_fqdns.split(",")
-            s_mode = tags.get(Tags.MODE)
-            s_http_port = tags.get(Tags.HTTP_PORT)
-            s_https_port = tags.get(Tags.HTTPS_PORT)
-            s_http_sanitize_codes = tags.get(Tags.HTTP_SANITIZE_CODES)
-            if s_http_sanitize_codes is not None:
-                s_http_sanitize_codes = s_http_sanitize_codes.split(",")
-            s_http_sanitize_return = tags.get(Tags.HTTP_SANITIZE_RETURN)
-
-            # If no annotation is defined for the name, use the service name
-            if not s_name:
-                s_name = service_name
-
-            # Retrieve backends
-            print("Tags processed, retrieving endpoints...")
-
-            _, endpoints = self._instance.catalog.service(service_name)
-
-            s_backends = map(
-                lambda e: (e.get("Address"), e.get("ServicePort")),
-                endpoints
+        services_computed = []
+        invalid = {}
+
+        for service_name, service_tags in services_tagged.items():
+            s_backends = NomadClient._backends(
+                services_endpoints[service_name]
             )
 
             plimni_service = None
 
             try:
-                plimni_service = Service(
+                plimni_service = self._factory.build(
+                    name=service_name,
+                    settings=NomadClient._settings(service_tags),
+                    backends=s_backends,
                     cluster_branch=cluster_branch,
                     cluster_domain=cluster_domain,
-                    expose=s_expose,
-                    name=s_name,
-                    branch=s_branch,
-                    fqdn=s_fqdn,
-                    additional_fqdns=s_additional_fqdns,
-                    mode=s_mode,
-                    http_port=s_http_port,
-                    https_port=s_https_port,
-                    http_sanitize_codes=s_http_sanitize_codes,
-                    http_sanitize_return=s_http_sanitize_return,
-                    backends=s_backends,
                 )
             except ValueError as err:
-                print("Can't process service {} because of: {}"
-                      "".format(service_name, str(err)))
+                plimni.metrics.SERVICES_INVALID.inc()
+                invalid[service_name] = str(err)
                 continue
 
+            plimni.metrics.SERVICES_PROCESSED.inc()
             services_computed.append(plimni_service)
 
+        self._factory.rotate()
+        self._report_invalid(invalid)
+
         return services_computed
 
     def get_certbot_url(self, private_ip: str) -> str:
         return "{}:8080".format(private_ip)
 
+    def _fetch_endpoints(
+            self, names: typing.Iterable[str],
+    ) -> typing.Dict[str, typing.Tuple[str, list]]:
+        """
+        Retrieve concurrently the Consul index and the endpoints of each of
+        the services `names`.
+        """
+        futures = {
+            name: self._executor.submit(self._query_endpoints, name)
+            for name in names
+        }
+
+        return {name: future.result() for name, future in futures.items()}
+
+    def _query_endpoints(self, name: str, **kwargs) -> tuple:
+        """
+        Retrieve the Consul index and the endpoints of the service `name`;
+        `kwargs` are given to Consul (e.g. for blocking queries).
+        """
+        if self._health:
+            return self._instance.health.service(name, passing=True, **kwargs)
+
+        return self._instance.catalog.service(name, **kwargs)
+
+    @staticmethod
+    def _is_tagged(service_tags) -> bool:
+        if not service_tags:
+            return False
+
+        return any(key.startswith(PREFIX) for key in service_tags)
+
+    @staticmethod
+    def _backends(endpoints) -> list:
+        backends = []
+
+        for e in endpoints:
+            if "Service" in e:
+                # An entry of the health API; services registered with their
+                # own address (e.g. on a bridge network) are not reached
+                # through the address of their node
+                weights = e["Service"].get("Weights") or {}
+                backends.append((
+                    e["Service"].get("Address") or e["Node"].get("Address"),
+                    e["Service"].get("Port"),
+                    min(weights.get("Passing", 1), NomadClient.MAX_WEIGHT),
+                ))
+            else:
+                backends.append((
+                    e.get("ServiceAddress") or e.get("Address"),
+                    e.get("ServicePort"),
+                ))
+
+        return backends
+
+    @staticmethod
+    def _instances(endpoints) -> typing.Set[tuple]:
+        """Return the (node, service ID) of the instances in `endpoints`."""
+        return {
+            (e["Node"].get("Node"), e["Service"].get("ID")) if "Service" in e
+            else (e.get("Node"), e.get("ServiceID"))
+            for e in endpoints
+        }
+
+    @staticmethod
+    def _service_checks(checks: list) -> typing.Dict[str, frozenset]:
+        """
+        Group the health `checks` by service, each service getting the checks
+        of the nodes it runs on too: a node failing its checks takes its
+        services out of the health API.
+        """
+        node_checks = {}
+        service_checks = {}
+
+        for check in checks:
+            item = (check.get("Node"), check.get("ServiceID"),
+                    check.get("CheckID"), check.get("ModifyIndex"))
+
+            if check.get("ServiceName"):
+                service_checks.setdefault(check["ServiceName"], set()).add(
+                    item
+                )
+            else:
+                node_checks.setdefault(check.get("Node"), set()).add(item)
+
+        return {
+            name: frozenset(items.union(*(
+                node_checks.get(node, ()) for node, _, _, _ in items
+            )))
+            for name, items in service_checks.items()
+        }
+
+    @staticmethod
+    def _settings(service_tags: list) -> typing.Dict[str, str]:
+        return dict(
+            tag.split("=", 1) for tag in service_tags if tag.startswith(PREFIX)
+        )
+
+    @staticmethod
+    def _next_index(old_index: str, new_index: str) -> str:
+        """
+        Return the index to use for the next blocking query. Consul documents
+        that an index going backwards must reset the blocking query.
+        """
+        if old_index is not None and int(new_index) < int(old_index):
+            return "0"
+
+        return new_index
+
+    def _start_watching(self):
+        if self._watching:
+            return
+
+        logger.info("Retrieving the Consul catalog before watching it...")
+
+        # The services are about to be built from this initial state, the
+        # main loop is not woken up for it (and the change event may be
+        # shared with other clients, it can't be cleared)
+        catalog_index, catalog = self._instance.catalog.services()
+        checks_index, checks = self._instance.health.state("any")
+        self._refresh(catalog, checks)
+
+        watches = [
+            ("catalog", self._instance.catalog.services, catalog_index),
+            # Health checks changing do not move the index of the catalog
+            ("health checks",
+             lambda **kwargs: self._instance.health.state("any", **kwargs),
+             checks_index),
+        ]
+
+        for name, query, index in watches:
+            threading.Thread(
+                target=self._watch_index,
+                args=(name, query, index),
+                name="plimni-watch-{}".format(name.replace(" ", "-")),
+                daemon=True,
+            ).start()
+
+        self._watching = True
+
+    def _refresh(self, catalog: dict = None, checks: list = None) -> bool:
+        """
+        Replace the catalog with `catalog` and the health checks with
+        `checks` (if given), retrieve the endpoints of the Plimni services
+        they show as changed and keep the ones whose Consul index moved;
+        return whether a Plimni service was added, removed, got its tags
+        changed or its backends changed.
+        """
+        # Both watches can refresh at the same time, and only a refresh
+        # changes what is compared here
+        with self._refresh_lock:
+            catalog_moved = catalog is not None
+
+            with self._lock:
+                if catalog is None:
+                    catalog = self._catalog
+
+                old_tagged = {
+                    name: tags for name, tags in self._catalog.items()
+                    if NomadClient._is_tagged(tags)
+                }
+
+            tagged = {
+                name: tags for name, tags in catalog.items()
+                if NomadClient._is_tagged(tags)
+            }
+
+            service_checks = self._checks if checks is None \
+                else NomadClient._service_checks(checks)
+
+            names = [
+                name for name in tagged
+                if name not in self._endpoints
+                or service_checks.get(name) != self._checks.get(name)
+                or (catalog_moved and name in self._unchecked)
+            ]
+
+            # Nothing is kept if a request fails, so the next refresh sees
+            # the same changes
+            new_endpoints = self._fetch_endpoints(names)
+
+            changed = tagged != old_tagged
+
+            with self._lock:
+                self._catalog = catalog
+                self._checks = service_checks
+
+                for name in old_tagged.keys() - tagged.keys():
+                    self._endpoints.pop(name, None)
+                    self._indexes.pop(name, None)
+                    self._unchecked.discard(name)
+
+                for name, (index, endpoints) in new_endpoints.items():
+                    checked = {
+                        (node, service_id) for node, service_id, _, _
+                        in service_checks.get(name, ())
+                    }
+                    if NomadClient._instances(endpoints) - checked:
+                        self._unchecked.add(name)
+                    else:
+                        self._unchecked.discard(name)
+
+                    if self._indexes.get(name) == index:
+                        continue
+
+                    old_endpoints = self._endpoints.get(name)
+                    self._indexes[name] = index
+                    self._endpoints[name] = endpoints
+
+                    if old_endpoints is None or (
+                            NomadClient._backends(old_endpoints)
+                            != NomadClient._backends(endpoints)):
+                        logger.debug("Service %s changed", name)
+                        changed = True
+
+            return changed
+
+    def _watch_index(self, name: str, query: typing.Callable, index: str):
+        """
+        Wait for the index of the blocking query `query` to move and refresh
+        the Plimni services when it did.
+        """
+        while True:
+            try:
+                new_index, result = query(
+                    index=index,
+                    wait=NomadClient.WATCH_WAIT,
+                )
+
+                if new_index == index:
+                    # The blocking query timed out without any change
+                    continue
+
+                if name == "catalog":
+                    changed = self._refresh(catalog=result)
+                else:
+                    changed = self._refresh(checks=result)
+
+                if changed:
+                    logger.info("Consul %s changed", name)
+                    self.notify_change()
+
+                index = NomadClient._next_index(index, new_index)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Error when watching the Consul %s: %s", name,
+                             exc)
+                time.sleep(NomadClient.WATCH_RETRY_DELAY)
+
 
-def get_client() -> Client:
-    return NomadClient(Consul())
+def get_client(watch: bool = False, concurrency: int = 10,
+               timeout: float = 10, health: bool = False,
+               host: str = "127.0.0.1", port: int = 8500,
+               datacenter: str = None) -> Client:
+    return NomadClient(
+        # The blocking queries of the watch mode need their own connections
+        ConsulClient(timeout=timeout, pool_size=concurrency + 2, host=host,
+                     port=port, dc=datacenter),
+        watch=watch,
+        concurrency=concurrency,
+        health=health,
+    )
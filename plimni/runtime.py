@@ -0,0 +1,238 @@
+import socket
+import typing
+
+
+class RuntimeAPI():
+    """
+    Send commands to a running HAProxy through its stats socket (the HAProxy
+    Runtime API). The socket has to be configured with `level admin`.
+
+    Args:
+        socket_path (str): The path of the HAProxy stats socket.
+        timeout (float): How long to wait for HAProxy to answer, in seconds.
+    """
+    # How many commands are sent at once (separated by `;`) on a connection
+    BATCH_SIZE = 50
+
+    # HAProxy answers with a message even when a command succeeded, these are
+    # the beginnings of the messages telling a command failed
+    ERRORS = (
+        "No such",
+        "Unknown command",
+        "Permission denied",
+        "Require",
+        "Invalid",
+    )
+
+    def __init__(self, socket_path: str, timeout: float = 5):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _send(self, line: str) -> str:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall((line + "\n").encode("utf-8"))
+
+            # HAProxy closes the connection once it answered
+            chunks = []
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+
+        return b"".join(chunks).decode("utf-8")
+
+    def execute(self, commands: typing.List[str]) -> str:
+        """
+        Send `commands` to HAProxy and return its answers. Raise a ValueError
+        if one of the commands failed.
+        """
+        output = []
+
+        for i in range(0, len(commands), RuntimeAPI.BATCH_SIZE):
+            batch = commands[i:i + RuntimeAPI.BATCH_SIZE]
+            answer = self._send("; ".join(batch))
+
+            for line in answer.splitlines():
+                if line.startswith(RuntimeAPI.ERRORS):
+                    raise ValueError("HAProxy refused a command of `{}`: {}"
+                                     "".format("; ".join(batch), line))
+
+            output.append(answer)
+
+        return "".join(output)
+
+    def set_ssl_cert(self, cert_file: str, content: str):
+        """
+        Replace the certificate HAProxy loaded from `cert_file` with
+        `content` (the private key and the certificates chain, as PEM) without
+        reloading it. Raise a ValueError if HAProxy refused it.
+        """
+        # The payload can't be batched with other commands, it ends at the
+        # first empty line
+        payload = "\n".join(
+            line for line in content.splitlines() if line.strip()
+        )
+        answer = self._send("set ssl cert {} <<\n{}\n".format(cert_file,
+                                                               payload))
+
+        if "Transaction" not in answer:
+            raise ValueError("HAProxy refused the certificate {}: {}"
+                             "".format(cert_file, answer.strip()))
+
+        answer = self._send("commit ssl cert {}".format(cert_file))
+
+        if "Success" not in answer:
+            self._send("abort ssl cert {}".format(cert_file))
+            raise ValueError("HAProxy could not commit the certificate {}: {}"
+                             "".format(cert_file, answer.strip()))
+
+
+def map_changes(map_file: str, old: typing.Dict[str, str],
+                new: typing.Dict[str, str]) -> typing.List[str]:
+    """
+    Return the Runtime API commands changing the entries of the map
+    `map_file` from `old` to `new`.
+    """
+    commands = []
+
+    for key in sorted(old.keys() - new.keys()):
+        commands.append("del map {} {}".format(map_file, key))
+
+    for key, value in sorted(new.items()):
+        if key not in old:
+            commands.append("add map {} {} {}".format(map_file, key, value))
+        elif old[key] != value:
+            commands.append("set map {} {} {}".format(map_file, key, value))
+
+    return commands
+
+
+class ServerSlots():
+    """
+    Give each backend (ip, port) of a service a server slot of its HAProxy
+    backend, and keep it in this slot as long as it exists.
+
+    Backends have more slots than servers (a power of 2, at least
+    `MIN_SLOTS`), so servers can come and go by changing the address and the
+    state of a slot through the Runtime API, without changing the structure
+    of the configuration (and thus without reloading HAProxy).
+
+    The slots of the HAProxy backends which were not assigned since the
+    previous call to `rotate` are dropped by the next one.
+    """
+    MIN_SLOTS = 4
+
+    # Address of the free slots
+    FREE_ADDRESS = ("127.0.0.1", 1)
+
+    def __init__(self):
+        # HAProxy backend name => list of (ip, port) or (ip, port, weight), or
+        # None for a free slot
+        self._slots = {}
+        self._assigned = set()
+        self._changes = []
+
+    @staticmethod
+    def server_name(slot: int) -> str:
+        return "srv{}".format(slot + 1)
+
+    @staticmethod
+    def _count(backends: int) -> int:
+        count = ServerSlots.MIN_SLOTS
+        while count < backends:
+            count *= 2
+        return count
+
+    def assign(self, backend: str, backends: list,
+               expose: bool) -> typing.Tuple[tuple, ...]:
+        """
+        Assign `backends` to the slots of the HAProxy backend `backend` and
+        return the slots as (server name, ip, port, weight) tuples, ip and
+        port being `None` for the free slots and weight being `None` when
+        the backend has none.
+        """
+        # Backends are (ip, port) or (ip, port, weight), indexed by address
+        wanted = {
+            tuple(b[:2]): tuple(b) for b in backends
+        } if expose else {}
+        slots = self._slots.get(backend)
+        needed = ServerSlots._count(len(wanted))
+
+        # Only shrink when much less slots are used, to avoid reloading HAProxy
+        # back and forth when the number of backends goes up and down
+        if slots is None or len(slots) < needed or len(slots) >= needed * 4:
+            new = True
+            slots = [None] * needed
+        else:
+            new = False
+            slots = list(slots)
+
+        for index, server in enumerate(slots):
+            if server is None:
+                continue
+
+            name = "{}/{}".format(backend, ServerSlots.server_name(index))
+
+            if server[:2] not in wanted:
+                slots[index] = None
+                self._changes.append("set server {} state maint".format(name))
+            elif wanted[server[:2]] != server:
+                # Only the weight can differ, HAProxy's default one is 1
+                slots[index] = wanted[server[:2]]
+                self._changes.append("set server {} weight {}"
+                                     "".format(name, (slots[index] + (1,))[2]))
+
+        used = set(server[:2] for server in slots if server is not None)
+        missing = sorted(
+            server for address, server in wanted.items() if address not in used
+        )
+        free = [index for index, server in enumerate(slots) if server is None]
+
+        for server, index in zip(missing, free):
+            slots[index] = server
+            name = "{}/{}".format(backend, ServerSlots.server_name(index))
+            self._changes.append("set server {} addr {} port {}"
+                                 "".format(name, server[0], server[1]))
+            # The slot may keep the weight of its previous server, servers
+            # without one get HAProxy's default one back
+            self._changes.append("set server {} weight {}"
+                                 "".format(name, (server + (1,))[2]))
+            self._changes.append("set server {} state ready".format(name))
+
+        if new:
+            # A new set of slots changes the structure of the configuration,
+            # HAProxy will be reloaded anyway
+            self._changes = [
+                change for change in self._changes
+                if not change.startswith("set server {}/".format(backend))
+            ]
+
+        self._slots[backend] = slots
+        self._assigned.add(backend)
+
+        return tuple(
+            (ServerSlots.server_name(index),) + (
+                (server + (None,))[:3] if server is not None
+                else (None, None, None)
+            )
+            for index, server in enumerate(slots)
+        )
+
+    def rotate(self):
+        """Drop the slots of the backends not assigned since last rotation."""
+        for backend in self._slots.keys() - self._assigned:
+            del self._slots[backend]
+
+        self._assigned = set()
+
+    def pop_changes(self) -> typing.List[str]:
+        """
+        Return the Runtime API commands applying the slots changes since the
+        last call, and forget them.
+        """
+        changes = self._changes
+        self._changes = []
+        return changes
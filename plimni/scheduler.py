@@ -0,0 +1,74 @@
+import time
+
+
+class ReloadScheduler():
+    """
+    Decide when HAProxy should be reloaded so that close changes (e.g. during
+    a rollout) are merged into a single reload.
+
+    A reload is due once no other reload was requested for `debounce`
+    seconds and at least `min_interval` seconds elapsed since the previous
+    reload, but never later than `max_delay` seconds after the first request
+    it merges.
+
+    Args:
+        debounce (float): How long to wait for other changes after a reload
+                          was requested, in seconds.
+        min_interval (float): The minimum time between 2 reloads, in seconds.
+        max_delay (float): The maximum time a reload can be delayed, in
+                           seconds.
+    """
+    def __init__(self, debounce: float, min_interval: float,
+                 max_delay: float, clock=time.monotonic):
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.max_delay = max_delay
+        self._clock = clock
+
+        self._first_request = None
+        self._last_request = None
+        self._last_reload = None
+
+        # How many reload requests were merged into another reload
+        self.avoided = 0
+
+    @property
+    def pending(self) -> bool:
+        return self._first_request is not None
+
+    def request(self):
+        """Ask for HAProxy to be reloaded."""
+        now = self._clock()
+
+        if self.pending:
+            self.avoided += 1
+        else:
+            self._first_request = now
+
+        self._last_request = now
+
+    def due_in(self) -> float:
+        """
+        Return in how many seconds the pending reload is due (0 if it is
+        already due), or `None` if no reload is pending.
+        """
+        if not self.pending:
+            return None
+
+        due = self._last_request + self.debounce
+
+        if self._last_reload is not None:
+            due = max(due, self._last_reload + self.min_interval)
+
+        due = min(due, self._first_request + self.max_delay)
+
+        return max(due - self._clock(), 0)
+
+    def is_due(self) -> bool:
+        return self.pending and self.due_in() == 0
+
+    def reloaded(self):
+        """Tell the pending reload was done."""
+        self._first_request = None
+        self._last_request = None
+        self._last_reload = self._clock()
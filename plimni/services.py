@@ -1,6 +1,7 @@
 import re
+import typing
 
-from plimni.tags import Tags
+from plimni.tags import PREFIX, Tags
 
 
 class Service():
@@ -34,14 +35,66 @@ class Service():
         http_sanitize_return (str): The code to send back instead of those
                                     catched.
         backends ([]tuple): A list (ip,port) couples of backends for this
-                            service.
+                            service, or (ip,port,weight) triplets if the
+                            orchestrator gives weights.
+        balance (str): The HAProxy load balancing algorithm (defaults to
+                       `leastconn`).
+        timeout_connect (str): How long HAProxy waits for a connection to a
+                               server (defaults to `10s`).
+        timeout_server (str): How long HAProxy waits for a server to answer
+                              (defaults to `10s`).
+        timeout_queue (str): How long a request can wait for a free
+                             connection slot when all the servers are at
+                             their `maxconn` (HAProxy default if not set).
+        maxconn (int): The maximum number of concurrent connections to each
+                       server (unlimited if not set).
+        http_reuse (str): The HAProxy policy of idle connections reuse
+                          (HAProxy default if not set).
+        slowstart (str): How long a server which comes back takes to get
+                         its full share of traffic (disabled if not set).
+        check_inter (str): The interval between 2 health checks (defaults to
+                           `1000`, i.e. 1 second).
+        check_fall (int): How many failed checks make a server down (defaults
+                          to 3).
+        check_rise (int): How many successful checks make a server up
+                          (defaults to 1).
+        cache_size (int): The size of the HAProxy cache of the responses of
+                          this service, in megabytes (no cache if not set).
+        cache_max_object_size (int): The size of the biggest response to
+                                     cache, in bytes (HAProxy default if not
+                                     set).
+        cache_max_age (int): How long a response stays cached, in seconds
+                             (defaults to 60).
     """
     STR_REGEX = re.compile(r"^[a-zA-Z0-9-_.]+$")
     CODES_REGEX = re.compile(r"^[1-5][0-9]{2}$")
+    TIME_REGEX = re.compile(r"^[0-9]+(us|ms|s|m|h|d)?$")
+
+    BALANCES = ("roundrobin", "static-rr", "leastconn", "first", "source",
+                "uri", "random")
+    HTTP_REUSES = ("never", "safe", "aggressive", "always")
+    # The biggest cache HAProxy accepts (`total-max-size`), in megabytes
+    MAX_CACHE_SIZE = 4095
+
+    # Services are immutable and numerous, they don't need a `__dict__`. Some
+    # attributes are only set depending on the mode, the FQDN or the codes.
+    __slots__ = (
+        "expose", "name", "additional_fqdns", "fqdn", "branch",
+        "branch_normalized", "mode", "http_port", "https_port", "sanitizes",
+        "http_sanitize_codes", "http_sanitize_return", "backends", "balance",
+        "timeout_connect", "timeout_server", "timeout_queue", "maxconn",
+        "http_reuse", "slowstart", "check_inter", "check_fall", "check_rise",
+        "cache_size", "cache_max_object_size", "cache_max_age", "_fingerprint",
+    )
 
     def __init__(self, cluster_branch, cluster_domain, expose, name,
                  branch, fqdn, additional_fqdns, mode, http_port, https_port,
                  http_sanitize_codes, http_sanitize_return, backends,
+                 balance=None, timeout_connect=None, timeout_server=None,
+                 timeout_queue=None, maxconn=None, http_reuse=None,
+                 slowstart=None, check_inter=None, check_fall=None,
+                 check_rise=None, cache_size=None, cache_max_object_size=None,
+                 cache_max_age=None,
                  ):
         # Clean data
         expose = False if expose is None else (
@@ -58,6 +111,13 @@ class Service():
         http_sanitize_return = "" if http_sanitize_return is None\
             else http_sanitize_return
         backends = [] if backends is None else backends
+        balance = "leastconn" if balance is None else balance
+        timeout_connect = "10s" if timeout_connect is None else timeout_connect
+        timeout_server = "10s" if timeout_server is None else timeout_server
+        timeout_queue = "" if timeout_queue is None else timeout_queue
+        http_reuse = "" if http_reuse is None else http_reuse
+        slowstart = "" if slowstart is None else slowstart
+        check_inter = "1000" if check_inter is None else check_inter
 
         # Check and process data
         self.expose = expose
@@ -67,7 +127,7 @@ class Service():
 
         self.name = name
 
-        self.additional_fqdns = additional_fqdns
+        self.additional_fqdns = list(additional_fqdns)
 
         if self.additional_fqdns:
             for f in self.additional_fqdns:
@@ -125,4 +185,258 @@ class Service():
             self.http_sanitize_codes = http_sanitize_codes
             self.http_sanitize_return = http_sanitize_return
 
-        self.backends = backends
+        self.backends = tuple(tuple(backend) for backend in backends)
+
+        if balance not in Service.BALANCES:
+            raise ValueError("{} must be one of {}"
+                             "".format(Tags.BALANCE,
+                                       ", ".join(Service.BALANCES)))
+
+        self.balance = balance
+
+        if http_reuse and http_reuse not in Service.HTTP_REUSES:
+            raise ValueError("{} must be one of {}"
+                             "".format(Tags.HTTP_REUSE,
+                                       ", ".join(Service.HTTP_REUSES)))
+
+        self.http_reuse = http_reuse
+
+        for tag, value in ((Tags.TIMEOUT_CONNECT, timeout_connect),
+                           (Tags.TIMEOUT_SERVER, timeout_server),
+                           (Tags.TIMEOUT_QUEUE, timeout_queue),
+                           (Tags.SLOWSTART, slowstart),
+                           (Tags.CHECK_INTER, check_inter)):
+            if value and not Service.TIME_REGEX.search(value):
+                raise ValueError("{} is not a valid duration (a number "
+                                 "followed by us, ms, s, m, h or d)"
+                                 "".format(tag))
+
+        self.timeout_connect = timeout_connect
+        self.timeout_server = timeout_server
+        self.timeout_queue = timeout_queue
+        self.slowstart = slowstart
+        self.check_inter = check_inter
+
+        try:
+            self.maxconn = 0 if maxconn is None else int(maxconn)
+            self.check_fall = 3 if check_fall is None else int(check_fall)
+            self.check_rise = 1 if check_rise is None else int(check_rise)
+        except ValueError as err:
+            raise ValueError("{}, {} and {} must be numbers"
+                             "".format(Tags.MAXCONN, Tags.CHECK_FALL,
+                                       Tags.CHECK_RISE)) from err
+
+        if self.maxconn < 0 or self.check_fall < 1 or self.check_rise < 1:
+            raise ValueError("{} can't be negative, {} and {} must be at "
+                             "least 1".format(Tags.MAXCONN, Tags.CHECK_FALL,
+                                              Tags.CHECK_RISE))
+
+        try:
+            self.cache_size = 0 if cache_size is None else int(cache_size)
+            self.cache_max_object_size = 0 if cache_max_object_size is None\
+                else int(cache_max_object_size)
+            self.cache_max_age = 60 if cache_max_age is None\
+                else int(cache_max_age)
+        except ValueError as err:
+            raise ValueError("{}, {} and {} must be numbers"
+                             "".format(Tags.CACHE_SIZE,
+                                       Tags.CACHE_MAX_OBJECT_SIZE,
+                                       Tags.CACHE_MAX_AGE)) from err
+
+        if (self.cache_size < 0 or self.cache_max_object_size < 0
+                or self.cache_max_age < 0):
+            raise ValueError("{}, {} and {} can't be negative"
+                             "".format(Tags.CACHE_SIZE,
+                                       Tags.CACHE_MAX_OBJECT_SIZE,
+                                       Tags.CACHE_MAX_AGE))
+
+        if self.cache_size > Service.MAX_CACHE_SIZE:
+            raise ValueError("{} can't be more than {} megabytes"
+                             "".format(Tags.CACHE_SIZE,
+                                       Service.MAX_CACHE_SIZE))
+
+        # HAProxy refuses objects bigger than half of the cache
+        if self.cache_max_object_size * 2 > self.cache_size * 1024 * 1024:
+            raise ValueError("{} must be at most half of {}"
+                             "".format(Tags.CACHE_MAX_OBJECT_SIZE,
+                                       Tags.CACHE_SIZE))
+
+        # Lists become tuples so the service is immutable and hashable
+        self.additional_fqdns = tuple(self.additional_fqdns)
+        if self.sanitizes:
+            self.http_sanitize_codes = tuple(self.http_sanitize_codes)
+
+        # Must be set last, it freezes the service
+        self._fingerprint = tuple(
+            (key, getattr(self, key)) for key in Service.__slots__[:-1]
+            if hasattr(self, key)
+        )
+
+    def __setattr__(self, key, value):
+        if hasattr(self, "_fingerprint"):
+            raise AttributeError("Services are immutable")
+
+        super().__setattr__(key, value)
+
+    @staticmethod
+    def restore(fingerprint: tuple) -> "Service":
+        """
+        Return the service `fingerprint` was taken from, without validating
+        it again.
+        """
+        svc = object.__new__(Service)
+
+        for key, value in fingerprint:
+            object.__setattr__(svc, key, value)
+
+        object.__setattr__(svc, "_fingerprint", fingerprint)
+
+        return svc
+
+    def fingerprint(self) -> tuple:
+        """
+        Return a hashable value made of all the attributes of this service:
+        two services with the same fingerprint generate the same
+        configuration.
+        """
+        return self._fingerprint
+
+
+def build_service(name: str, settings: typing.Dict[str, str],
+                  backends: list, cluster_branch: str,
+                  cluster_domain: str) -> Service:
+    """
+    Build the service `name` from its Plimni settings (the annotations or the
+    tags of the orchestrator service).
+    """
+    s_expose = settings.get(Tags.EXPOSE)
+    s_name = settings.get(Tags.NAME)
+    s_branch = settings.get(Tags.BRANCH)
+    s_fqdn = settings.get(Tags.FQDN)
+    s_additional_fqdns = settings.get(Tags.ADDITIONAL_FQDNS)
+    if s_additional_fqdns is not None:
+        s_additional_fqdns = s_additional_fqdns.split(",")
+    s_mode = settings.get(Tags.MODE)
+    s_http_port = settings.get(Tags.HTTP_PORT)
+    s_https_port = settings.get(Tags.HTTPS_PORT)
+    s_http_sanitize_codes = settings.get(Tags.HTTP_SANITIZE_CODES)
+    if s_http_sanitize_codes is not None:
+        s_http_sanitize_codes = s_http_sanitize_codes.split(",")
+    s_http_sanitize_return = settings.get(Tags.HTTP_SANITIZE_RETURN)
+    s_balance = settings.get(Tags.BALANCE)
+    s_timeout_connect = settings.get(Tags.TIMEOUT_CONNECT)
+    s_timeout_server = settings.get(Tags.TIMEOUT_SERVER)
+    s_timeout_queue = settings.get(Tags.TIMEOUT_QUEUE)
+    s_maxconn = settings.get(Tags.MAXCONN)
+    s_http_reuse = settings.get(Tags.HTTP_REUSE)
+    s_slowstart = settings.get(Tags.SLOWSTART)
+    s_check_inter = settings.get(Tags.CHECK_INTER)
+    s_check_fall = settings.get(Tags.CHECK_FALL)
+    s_check_rise = settings.get(Tags.CHECK_RISE)
+    s_cache_size = settings.get(Tags.CACHE_SIZE)
+    s_cache_max_object_size = settings.get(Tags.CACHE_MAX_OBJECT_SIZE)
+    s_cache_max_age = settings.get(Tags.CACHE_MAX_AGE)
+
+    # If no annotation is defined for the name, use the service name
+    if not s_name:
+        s_name = name
+
+    return Service(
+        cluster_branch=cluster_branch,
+        cluster_domain=cluster_domain,
+        expose=s_expose,
+        name=s_name,
+        branch=s_branch,
+        fqdn=s_fqdn,
+        additional_fqdns=s_additional_fqdns,
+        mode=s_mode,
+        http_port=s_http_port,
+        https_port=s_https_port,
+        http_sanitize_codes=s_http_sanitize_codes,
+        http_sanitize_return=s_http_sanitize_return,
+        backends=backends,
+        balance=s_balance,
+        timeout_connect=s_timeout_connect,
+        timeout_server=s_timeout_server,
+        timeout_queue=s_timeout_queue,
+        maxconn=s_maxconn,
+        http_reuse=s_http_reuse,
+        slowstart=s_slowstart,
+        check_inter=s_check_inter,
+        check_fall=s_check_fall,
+        check_rise=s_check_rise,
+        cache_size=s_cache_size,
+        cache_max_object_size=s_cache_max_object_size,
+        cache_max_age=s_cache_max_age,
+    )
+
+
+class ServiceFactory():
+    """
+    Build services from their Plimni settings and backends, reusing the
+    service (or the validation error) built from the same ones instead of
+    validating everything again.
+
+    The services which were not built since the previous call to `rotate`
+    are dropped by the next one.
+    """
+    def __init__(self):
+        # key => service, or the message of its validation error
+        self._services = {}
+        self._built = {}
+        self.hits = 0
+        self.misses = 0
+
+    def build(self, name: str, settings: typing.Dict[str, str],
+              backends: list, cluster_branch: str,
+              cluster_domain: str) -> Service:
+        """
+        See `build_service`; raise a ValueError if the service is invalid.
+        """
+        key = (
+            name,
+            tuple(sorted(
+                (setting, value) for setting, value in settings.items()
+                if setting.startswith(PREFIX)
+            )),
+            tuple(backends),
+            cluster_branch,
+            cluster_domain,
+        )
+
+        service = self._built.get(key)
+
+        if service is None:
+            service = self._services.get(key)
+
+            if service is None:
+                self.misses += 1
+
+                try:
+                    service = build_service(
+                        name=name,
+                        settings=settings,
+                        backends=backends,
+                        cluster_branch=cluster_branch,
+                        cluster_domain=cluster_domain,
+                    )
+                except ValueError as err:
+                    service = str(err)
+            else:
+                self.hits += 1
+
+            self._built[key] = service
+        else:
+            self.hits += 1
+
+        # A new exception is raised every time, raising the same one again
+        # would make its traceback grow
+        if isinstance(service, str):
+            raise ValueError(service)
+
+        return service
+
+    def rotate(self):
+        """Drop the services which were not built since the last rotation."""
+        self._services = self._built
+        self._built = {}
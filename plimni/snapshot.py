@@ -0,0 +1,110 @@
+import gzip
+import json
+import logging
+import os
+import time
+import typing
+import zlib
+
+from .services import Service
+
+logger = logging.getLogger(__name__)
+
+# To change whenever what is saved changes, older snapshots are then ignored
+SCHEMA_VERSION = 3
+
+
+def _freeze(value):
+    """Turn the lists JSON gives back into the tuples services are made of."""
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+
+    return value
+
+
+def dumps(services: typing.List[Service], cluster_branch: str,
+          cluster_domain: str) -> bytes:
+    """
+    Return `services` (their fingerprints, which hold all their attributes)
+    as gzipped JSON.
+    """
+    snapshot = {
+        "version": SCHEMA_VERSION,
+        "saved_at": time.time(),
+        "cluster_branch": cluster_branch,
+        "cluster_domain": cluster_domain,
+        "services": [svc.fingerprint() for svc in services],
+    }
+
+    return gzip.compress(
+        json.dumps(snapshot, separators=(",", ":")).encode("utf-8"),
+    )
+
+
+def loads(data: bytes, origin: str, max_age: float, cluster_branch: str,
+          cluster_domain: str) -> typing.List[Service]:
+    """
+    Return the services of the snapshot `data` (read from `origin`), or
+    `None` if it is not usable (older than `max_age` seconds if given, saved
+    by another version of Plimni or for another cluster).
+    """
+    try:
+        snapshot = json.loads(gzip.decompress(data).decode("utf-8"))
+    except (OSError, EOFError, ValueError, zlib.error) as exc:
+        logger.warning("Can't read the snapshot %s: %s", origin, exc)
+        return None
+
+    if snapshot.get("version") != SCHEMA_VERSION:
+        logger.info("Ignoring the snapshot %s, it was saved with the schema "
+                    "version %s", origin, snapshot.get("version"))
+        return None
+
+    age = time.time() - snapshot["saved_at"]
+
+    if max_age is not None and age > max_age:
+        logger.info("Ignoring the snapshot %s, it is %d seconds old",
+                    origin, age)
+        return None
+
+    if (snapshot["cluster_branch"] != cluster_branch
+            or snapshot["cluster_domain"] != cluster_domain):
+        logger.info("Ignoring the snapshot %s, it was saved for another "
+                    "cluster", origin)
+        return None
+
+    return [
+        Service.restore(_freeze(fingerprint))
+        for fingerprint in snapshot["services"]
+    ]
+
+
+def save(file_path: str, services: typing.List[Service], cluster_branch: str,
+         cluster_domain: str):
+    """Save `services` to `file_path` (see `dumps`)."""
+    data = dumps(services, cluster_branch, cluster_domain)
+
+    # Plimni could be stopped while writing, never leave a partial snapshot
+    with open(file_path + ".tmp", "wb") as file_:
+        file_.write(data)
+
+    os.rename(file_path + ".tmp", file_path)
+
+
+def load(file_path: str, max_age: float, cluster_branch: str,
+         cluster_domain: str) -> typing.List[Service]:
+    """
+    Return the services saved to `file_path`, or `None` if there is no
+    usable snapshot (see `loads`).
+    """
+    if not os.path.isfile(file_path):
+        logger.info("No snapshot found at %s", file_path)
+        return None
+
+    try:
+        with open(file_path, "rb") as file_:
+            data = file_.read()
+    except OSError as exc:
+        logger.warning("Can't read the snapshot %s: %s", file_path, exc)
+        return None
+
+    return loads(data, file_path, max_age, cluster_branch, cluster_domain)
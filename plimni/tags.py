@@ -11,3 +11,17 @@ class Tags():
     HTTPS_PORT = "{}/https-port".format(PREFIX)
     HTTP_SANITIZE_CODES = "{}/http-sanitize-codes".format(PREFIX)
     HTTP_SANITIZE_RETURN = "{}/http-sanitize-return".format(PREFIX)
+    PORT_NAME = "{}/port-name".format(PREFIX)
+    BALANCE = "{}/balance".format(PREFIX)
+    TIMEOUT_CONNECT = "{}/timeout-connect".format(PREFIX)
+    TIMEOUT_SERVER = "{}/timeout-server".format(PREFIX)
+    TIMEOUT_QUEUE = "{}/timeout-queue".format(PREFIX)
+    MAXCONN = "{}/maxconn".format(PREFIX)
+    HTTP_REUSE = "{}/http-reuse".format(PREFIX)
+    SLOWSTART = "{}/slowstart".format(PREFIX)
+    CHECK_INTER = "{}/check-inter".format(PREFIX)
+    CHECK_FALL = "{}/check-fall".format(PREFIX)
+    CHECK_RISE = "{}/check-rise".format(PREFIX)
+    CACHE_SIZE = "{}/cache-size".format(PREFIX)
+    CACHE_MAX_OBJECT_SIZE = "{}/cache-max-object-size".format(PREFIX)
+    CACHE_MAX_AGE = "{}/cache-max-age".format(PREFIX)
@@ -0,0 +1,43 @@
+import os
+
+import jinja2
+
+
+TEMPLATES_FOLDER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "templates",
+)
+
+_ENVIRONMENT = None
+
+
+def setup(bytecode_cache_folder: str = None) -> jinja2.Environment:
+    """
+    Create the Jinja environment shared by the whole process.
+
+    Templates are compiled once and kept in memory; they are only compiled
+    again when their file changes. If `bytecode_cache_folder` is set, the
+    compiled templates are also stored there so they survive restarts.
+    """
+    global _ENVIRONMENT  # pylint: disable=global-statement
+
+    bytecode_cache = None
+
+    if bytecode_cache_folder:
+        os.makedirs(bytecode_cache_folder, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_folder)
+
+    _ENVIRONMENT = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(TEMPLATES_FOLDER),
+        auto_reload=True,
+        bytecode_cache=bytecode_cache,
+    )
+
+    return _ENVIRONMENT
+
+
+def get_template(name: str) -> jinja2.Template:
+    """Return the compiled template `name` from the templates folder."""
+    if _ENVIRONMENT is None:
+        setup()
+
+    return _ENVIRONMENT.get_template(name)
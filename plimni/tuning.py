@@ -0,0 +1,161 @@
+import math
+import os
+import re
+import typing
+
+import plimni.templating
+
+TEMPLATE = "haproxy_global.cfg.j2"
+
+# Where the CPU quota and the memory limit of the container are, with cgroup
+# v2 then v1
+CGROUP_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_CPU_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_CPU_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+CGROUP_MEMORY_MAX = "/sys/fs/cgroup/memory.max"
+CGROUP_MEMORY_LIMIT = "/sys/fs/cgroup/memory/memory.limit_in_bytes"
+MEMINFO = "/proc/meminfo"
+
+# The share of the memory HAProxy can spend on connections, the rest is left
+# to the SSL cache, the maps, the configuration...
+CONNECTIONS_MEMORY_RATIO = 0.75
+# What an SSL connection costs on top of its 2 buffers, in bytes
+SSL_CONNECTION_MEMORY = 32768
+# What an entry of the SSL sessions cache costs, in bytes
+SSL_CACHE_ENTRY_MEMORY = 200
+MIN_MAXCONN = 1000
+MIN_SSL_CACHESIZE = 20000
+
+MEMORY_UNITS = {
+    "": 1,
+    "k": 1000, "m": 1000 ** 2, "g": 1000 ** 3,
+    "ki": 1024, "mi": 1024 ** 2, "gi": 1024 ** 3,
+}
+MEMORY_REGEX = re.compile(r"^([0-9]+)([kmg]i?)?b?$", re.IGNORECASE)
+
+
+def parse_memory(value: str) -> int:
+    """
+    Return the memory `value` in bytes; it can have a unit (`500M`, `7Gi`,
+    `2GB`...).
+    """
+    match = MEMORY_REGEX.search(value.strip())
+
+    if not match:
+        raise ValueError("{} is not a valid amount of memory".format(value))
+
+    return int(match.group(1)) * MEMORY_UNITS[(match.group(2) or "").lower()]
+
+
+def _read(file_path: str) -> str:
+    with open(file_path) as file_:
+        return file_.read().strip()
+
+
+def cgroup_cpu_quota() -> float:
+    """
+    Return how many CPUs the cgroup of Plimni can use, or `None` if it has no
+    CPU quota.
+    """
+    try:
+        quota, period = _read(CGROUP_CPU_MAX).split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        quota = int(_read(CGROUP_CPU_QUOTA))
+        return quota / int(_read(CGROUP_CPU_PERIOD)) if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def detect_cpus() -> typing.List[int]:
+    """
+    Return the CPUs Plimni can run on, limited to as many as its cgroup CPU
+    quota allows (rounded up).
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    quota = cgroup_cpu_quota()
+
+    if quota is not None:
+        cpus = cpus[:max(math.ceil(quota), 1)]
+
+    return cpus
+
+
+def detect_memory() -> int:
+    """
+    Return the memory Plimni can use, in bytes: the memory of the host,
+    limited by its cgroup.
+    """
+    limits = []
+
+    try:
+        for line in _read(MEMINFO).splitlines():
+            if line.startswith("MemTotal:"):
+                limits.append(int(line.split()[1]) * 1024)
+    except (OSError, ValueError):
+        pass
+
+    for file_path in (CGROUP_MEMORY_MAX, CGROUP_MEMORY_LIMIT):
+        try:
+            # Without limit, cgroup v1 gives a huge number and v2 gives `max`
+            limits.append(int(_read(file_path)))
+        except (OSError, ValueError):
+            pass
+
+    if not limits:
+        raise ValueError("Can't detect the memory, set it explicitly")
+
+    return min(limits)
+
+
+def settings(cpus: int = None, memory: int = None, maxconn: int = None,
+             bufsize: int = 16384, cpu_map: bool = False) -> dict:
+    """
+    Return the HAProxy tuning settings for `cpus` CPUs and `memory` bytes of
+    memory, detected from the host and the cgroup of Plimni if not given.
+    `maxconn` is derived from the memory if not given.
+    """
+    detected_cpus = detect_cpus()
+
+    if cpus is None:
+        cpus = len(detected_cpus)
+
+    if memory is None:
+        memory = detect_memory()
+
+    if maxconn is None:
+        maxconn = max(
+            int(memory * CONNECTIONS_MEMORY_RATIO
+                // (2 * bufsize + SSL_CONNECTION_MEMORY)),
+            MIN_MAXCONN,
+        )
+
+    # One SSL session per connection, within what is left of the memory
+    ssl_cachesize = max(
+        min(maxconn, int(memory * (1 - CONNECTIONS_MEMORY_RATIO)
+                         // SSL_CACHE_ENTRY_MEMORY)),
+        MIN_SSL_CACHESIZE,
+    )
+
+    # Each thread gets its own CPU, which only makes sense if HAProxy runs
+    # on the same CPUs as Plimni
+    if len(detected_cpus) < cpus:
+        cpu_map = False
+
+    return {
+        "cpus": cpus,
+        "memory": memory,
+        "nbthread": cpus,
+        "cpu_map": detected_cpus[:cpus] if cpu_map else [],
+        "maxconn": maxconn,
+        "bufsize": bufsize,
+        "ssl_cachesize": ssl_cachesize,
+    }
+
+
+def render(tuning: dict) -> str:
+    """Render the HAProxy global and defaults sections from `tuning`."""
+    return plimni.templating.get_template(TEMPLATE).render(**tuning) + "\n"
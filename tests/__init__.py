@@ -0,0 +1,5 @@
+import logging
+
+# Background threads (watches, elections...) outlive the stand-ins they talk
+# to; their errors are expected and would only clutter the output
+logging.disable(logging.CRITICAL)
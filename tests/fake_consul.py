@@ -0,0 +1,179 @@
+import http.server
+import json
+import threading
+import urllib.parse
+
+
+class FakeConsul():
+    """
+    A local Consul HTTP API answering the catalog and health endpoints used
+    by Plimni, with blocking queries.
+
+    Every write moves the global index (returned by the catalog and health
+    checks lists) and the index of the services it touched, as Consul does.
+
+    Args:
+        max_wait (float): How long blocking queries wait at most, in seconds,
+                          whatever `wait` they ask for.
+    """
+    def __init__(self, max_wait: float = 0.5):
+        self.max_wait = max_wait
+        self.index = 1
+        # service name => tags, endpoints and index
+        self.services = {}
+        # (method, path) of the requests received
+        self.requests = []
+
+        self._condition = threading.Condition()
+
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                url = urllib.parse.urlparse(self.path)
+                params = dict(urllib.parse.parse_qsl(url.query))
+                fake.requests.append(("GET", url.path))
+
+                index, body = fake.answer(url.path, params)
+
+                if body is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("X-Consul-Index", str(index))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                                       Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def set_service(self, name: str, tags: list = None,
+                    endpoints: list = None, index: int = None,
+                    checks: bool = True):
+        """
+        Register the service `name` with its `tags` and its `endpoints` (a
+        list of (node address, port, passing) tuples, with the address of
+        the service as 4th item if it has its own), moving the indexes.
+        Each endpoint gets a health check, unless `checks` is false.
+        """
+        with self._condition:
+            self.index = index if index is not None else self.index + 1
+            self.services[name] = {
+                "tags": tags or [],
+                "endpoints": endpoints or [],
+                "index": self.index,
+                "checks": checks,
+            }
+            self._condition.notify_all()
+
+    def set_index(self, index: int):
+        """Move the global index without any change (e.g. a reset)."""
+        with self._condition:
+            self.index = index
+            self._condition.notify_all()
+
+    def _wait(self, params: dict, current: callable):
+        if "index" not in params:
+            return
+
+        self._condition.wait_for(
+            lambda: str(current()) != params["index"],
+            timeout=self.max_wait,
+        )
+
+    def answer(self, path: str, params: dict) -> tuple:
+        with self._condition:
+            if path == "/v1/catalog/services":
+                self._wait(params, lambda: self.index)
+                return self.index, {
+                    name: svc["tags"] for name, svc in self.services.items()
+                }
+
+            if path == "/v1/health/state/any":
+                self._wait(params, lambda: self.index)
+                return self.index, self._checks()
+
+            kind, _, name = path[len("/v1/"):].partition("/service/")
+            svc = self.services.get(name)
+
+            if svc is None or kind not in ("catalog", "health"):
+                return self.index, None
+
+            self._wait(params, lambda: svc["index"])
+
+            endpoints = [
+                tuple(endpoint) + ("",) * (4 - len(endpoint))
+                for endpoint in svc["endpoints"]
+            ]
+
+            if kind == "catalog":
+                return svc["index"], [
+                    {"Node": address, "Address": address,
+                     "ServiceID": "{}-{}".format(name, i),
+                     "ServiceAddress": service_address, "ServicePort": port}
+                    for i, (address, port, _, service_address)
+                    in enumerate(endpoints)
+                ]
+
+            return svc["index"], [
+                {
+                    "Node": {"Node": address, "Address": address},
+                    "Service": {"ID": "{}-{}".format(name, i),
+                                "Address": service_address, "Port": port,
+                                "Weights": {"Passing": 1}},
+                }
+                for i, (address, port, passing, service_address)
+                in enumerate(endpoints)
+                if passing or params.get("passing") is None
+            ]
+
+    def _checks(self) -> list:
+        """
+        Return the health checks: one per node, and one per endpoint of the
+        services with checks, modified along with their service.
+        """
+        checks = []
+        nodes = set()
+
+        for name, svc in self.services.items():
+            for i, endpoint in enumerate(svc["endpoints"]):
+                nodes.add(endpoint[0])
+
+                if svc["checks"]:
+                    checks.append({
+                        "Node": endpoint[0],
+                        "CheckID": "service:{}-{}".format(name, i),
+                        "ServiceID": "{}-{}".format(name, i),
+                        "ServiceName": name,
+                        "Status": "passing" if endpoint[2] else "critical",
+                        "ModifyIndex": svc["index"],
+                    })
+
+        for node in sorted(nodes):
+            checks.append({
+                "Node": node,
+                "CheckID": "serfHealth",
+                "ServiceID": "",
+                "ServiceName": "",
+                "Status": "passing",
+                "ModifyIndex": 1,
+            })
+
+        return checks
@@ -0,0 +1,93 @@
+import threading
+import unittest
+
+from plimni.clients import Client, DiscoveryError
+from plimni.composite import CompositeClient, parse_source
+from plimni.services import build_service
+from plimni.tags import Tags
+
+
+class StubClient(Client):
+    """
+    A source answering the services `names`, once `release` is set if
+    `slow`.
+
+    Args:
+        names (list): The names of the services it answers.
+        slow (bool): Whether it waits for `release` to answer.
+    """
+    def __init__(self, names: list, slow: bool = False):
+        super().__init__()
+        self.names = names
+        self.release = threading.Event()
+        if not slow:
+            self.release.set()
+
+    def get_services(self, cluster_branch: str, cluster_domain: str):
+        self.release.wait(5)
+        return [
+            build_service(
+                name=name,
+                settings={Tags.EXPOSE: "true"},
+                backends=[("10.0.0.1", 8080)],
+                cluster_branch=cluster_branch,
+                cluster_domain=cluster_domain,
+            )
+            for name in self.names
+        ]
+
+
+class CompositeClientTest(unittest.TestCase):
+    def get_names(self, client: CompositeClient) -> list:
+        return sorted(svc.name for svc in client.get_services(
+            cluster_branch="master", cluster_domain="example.com",
+        ))
+
+    def test_parse_source(self):
+        self.assertEqual(parse_source("nomad:host=10.0.0.1,port=8501"), (
+            "nomad", {"consul_host": "10.0.0.1", "consul_port": 8501}, None,
+        ))
+        self.assertEqual(parse_source("k8s:namespace=shop,timeout=2"),
+                         ("k8s", {"k8s_namespace": "shop"}, 2))
+
+        for source in ("swarm", "k8s:host=10.0.0.1", "nomad:port=http"):
+            with self.assertRaises(ValueError):
+                parse_source(source)
+
+    def test_slow_source(self):
+        fast = StubClient(["blog"])
+        slow = StubClient(["shop"], slow=True)
+        client = CompositeClient({"fast": fast, "slow": slow},
+                                 {"fast": 1, "slow": 0.1})
+
+        notified = []
+        notify_change = client.notify_change
+
+        def count_notify():
+            notified.append(True)
+            notify_change()
+
+        client.notify_change = count_notify
+
+        # Still running: the slow source is not queried again
+        for _ in range(3):
+            with self.assertRaises(DiscoveryError):
+                self.get_names(client)
+
+        self.assertFalse(client.wait_for_change(0))
+
+        # Its late answer wakes the main loop up, once
+        slow.release.set()
+        self.assertTrue(client.wait_for_change(5))
+        self.assertFalse(client.wait_for_change(0.1))
+        self.assertEqual(len(notified), 1)
+
+        self.assertEqual(self.get_names(client), ["blog", "shop"])
+
+        # Answers in time are not changes
+        self.assertEqual(self.get_names(client), ["blog", "shop"])
+        self.assertFalse(client.wait_for_change(0.1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,387 @@
+import copy
+import datetime
+import tempfile
+import time
+import unittest
+
+import consul
+from kubernetes.client.rest import ApiException
+
+import plimni.leader
+from plimni.leader import ConsulStore, Election, FileStore, KubernetesStore
+from plimni.services import build_service
+from plimni.tags import Tags
+
+BRANCH = "master"
+DOMAIN = "example.com"
+
+
+def services(*names) -> list:
+    return [
+        build_service(
+            name=name,
+            settings={Tags.EXPOSE: "true"},
+            backends=[("10.0.0.1", 8080)],
+            cluster_branch=BRANCH,
+            cluster_domain=DOMAIN,
+        )
+        for name in names
+    ]
+
+
+class FakeConsul():
+    """The sessions and the KV store of Consul, as used by `ConsulStore`."""
+    def __init__(self):
+        self.session = self
+        self.kv = self
+        self.index = 0
+        # session => alive
+        self.sessions = {}
+        # key => value, session holding it, modify index
+        self.entries = {}
+
+    def create(self, name, ttl, behavior, lock_delay):
+        session = "{}-{}".format(name, len(self.sessions))
+        self.sessions[session] = True
+        return session
+
+    def renew(self, session):
+        if not self.sessions.get(session):
+            raise consul.NotFound()
+
+    def expire(self, session):
+        """Invalidate `session` as if its TTL elapsed, releasing its locks."""
+        self.sessions[session] = False
+        for key, (value, holder, index) in self.entries.items():
+            if holder == session:
+                self.entries[key] = value, None, index
+
+    def put(self, key, value, acquire=None):
+        _, holder, _ = self.entries.get(key, (None, None, None))
+
+        if acquire is not None and holder not in (None, acquire):
+            return False
+
+        self.index += 1
+        self.entries[key] = value, acquire or holder, self.index
+        return True
+
+    def get(self, key):
+        if key not in self.entries:
+            return self.index, None
+
+        value, _, index = self.entries[key]
+        return self.index, {"Value": value, "ModifyIndex": index}
+
+
+class FakeKubernetes():
+    """
+    The Leases and ConfigMaps of the Kubernetes API, as used by
+    `KubernetesStore`, with their resource versions.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.version = 0
+
+    def _read(self, name):
+        if name not in self.objects:
+            raise ApiException(status=404)
+
+        obj = copy.deepcopy(self.objects[name])
+
+        # The client gives MicroTimes back as datetimes
+        spec = getattr(obj, "spec", None)
+        if spec is not None and isinstance(spec.renew_time, str):
+            spec.renew_time = datetime.datetime.strptime(
+                spec.renew_time, "%Y-%m-%dT%H:%M:%S.%fZ",
+            ).replace(tzinfo=datetime.timezone.utc)
+
+        return obj
+
+    def _create(self, obj):
+        if obj.metadata.name in self.objects:
+            raise ApiException(status=409)
+
+        self._store(obj)
+
+    def _replace(self, name, obj):
+        if name not in self.objects:
+            raise ApiException(status=404)
+
+        version = obj.metadata.resource_version
+        if version is not None and version != \
+                self.objects[name].metadata.resource_version:
+            raise ApiException(status=409)
+
+        self._store(obj)
+
+    def _store(self, obj):
+        self.version += 1
+        obj = copy.deepcopy(obj)
+        obj.metadata.resource_version = str(self.version)
+        self.objects[obj.metadata.name] = obj
+
+    def age(self, name, seconds):
+        """Make the Lease `name` renewed `seconds` ago."""
+        self.objects[name].spec.renew_time = (
+            datetime.datetime.now(datetime.timezone.utc)
+            - datetime.timedelta(seconds=seconds)
+        ).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    def read_namespaced_lease(self, name, namespace):
+        return self._read(name)
+
+    def create_namespaced_lease(self, namespace, lease):
+        self._create(lease)
+
+    def replace_namespaced_lease(self, name, namespace, lease):
+        self._replace(name, lease)
+
+    def read_namespaced_config_map(self, name, namespace):
+        return self._read(name)
+
+    def create_namespaced_config_map(self, namespace, config_map):
+        self._create(config_map)
+
+    def replace_namespaced_config_map(self, name, namespace, config_map):
+        self._replace(name, config_map)
+
+
+class StoreTest():
+    """The behaviour every store must have, with `self.stores()`."""
+    def stores(self) -> tuple:
+        raise NotImplementedError()
+
+    def expire(self, store, identity: str):
+        raise NotImplementedError()
+
+    def test_acquire(self):
+        first, second = self.stores()
+
+        self.assertTrue(first.acquire("first", 30))
+        self.assertFalse(second.acquire("second", 30))
+        # Renewing the leadership
+        self.assertTrue(first.acquire("first", 30))
+        self.assertFalse(second.acquire("second", 30))
+
+    def test_handover(self):
+        first, second = self.stores()
+
+        self.assertTrue(first.acquire("first", 30))
+        self.expire(first, "first")
+
+        self.assertTrue(second.acquire("second", 30))
+        self.assertFalse(first.acquire("first", 30))
+
+    def test_publish_fetch(self):
+        first, second = self.stores()
+
+        self.assertEqual(second.fetch(None), (None, None))
+
+        first.publish(b"one")
+        version, data = second.fetch(None)
+        self.assertEqual(data, b"one")
+        self.assertEqual(second.fetch(version), (version, None))
+
+        first.publish(b"two")
+        new_version, data = second.fetch(version)
+        self.assertNotEqual(new_version, version)
+        self.assertEqual(data, b"two")
+
+
+class ConsulStoreTest(StoreTest, unittest.TestCase):
+    def stores(self) -> tuple:
+        self.consul = FakeConsul()
+        return (ConsulStore(self.consul, "plimni"),
+                ConsulStore(self.consul, "plimni"))
+
+    def expire(self, store, identity):
+        self.consul.expire(store._session)
+
+    def test_session_renewed(self):
+        first, _ = self.stores()
+        first.acquire("first", 30)
+        session = first._session
+
+        first.acquire("first", 30)
+        self.assertEqual(first._session, session)
+
+        # An expired session is replaced
+        self.consul.expire(session)
+        self.assertTrue(first.acquire("first", 30))
+        self.assertNotEqual(first._session, session)
+
+
+class KubernetesStoreTest(StoreTest, unittest.TestCase):
+    def stores(self) -> tuple:
+        self.kubernetes = FakeKubernetes()
+        return tuple(
+            KubernetesStore(self.kubernetes, self.kubernetes, "plimni",
+                            "plimni")
+            for _ in range(2)
+        )
+
+    def expire(self, store, identity):
+        self.kubernetes.age("plimni-leader", 60)
+
+    def test_conflict(self):
+        first, second = self.stores()
+        first.acquire("first", 30)
+        self.expire(first, "first")
+
+        # Another instance took the Lease between the read and the update
+        read = self.kubernetes.read_namespaced_lease
+
+        def read_then_steal(name, namespace):
+            lease = read(name, namespace)
+            self.kubernetes._store(copy.deepcopy(
+                self.kubernetes.objects[name]
+            ))
+            return lease
+
+        self.kubernetes.read_namespaced_lease = read_then_steal
+        self.assertFalse(second.acquire("second", 30))
+
+
+class FileStoreTest(StoreTest, unittest.TestCase):
+    def stores(self) -> tuple:
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        return FileStore(folder.name), FileStore(folder.name)
+
+    def expire(self, store, identity):
+        with open(store._lock_file, "w") as file_:
+            file_.write("{} {}".format(identity, time.time() - 1))
+
+
+class ElectionTest(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.store = FileStore(folder.name)
+
+        self.first = Election(self.store, "first", 30, BRANCH, DOMAIN)
+        self.second = Election(self.store, "second", 30, BRANCH, DOMAIN)
+
+    def test_publish_fetch(self):
+        self.assertTrue(self.first.is_leader())
+        self.assertFalse(self.second.is_leader())
+        self.assertIsNone(self.second.fetch())
+        # Nothing published yet
+        self.assertTrue(self.second.fallback)
+
+        self.first.publish(services("blog", "shop"))
+        fetched = self.second.fetch()
+        self.assertEqual(sorted(svc.name for svc in fetched),
+                         ["blog", "shop"])
+        self.assertFalse(self.second.fallback)
+
+        # Nothing new until the leader publishes other services
+        self.assertIsNone(self.second.fetch())
+        self.first.publish(services("blog", "shop"))
+        self.assertIsNone(self.second.fetch())
+
+        self.first.publish(services("blog"))
+        self.assertEqual([svc.name for svc in self.second.fetch()],
+                         ["blog"])
+
+    def test_unusable_snapshot(self):
+        self.store.publish(b"not a snapshot")
+        self.assertIsNone(self.second.fetch())
+        self.assertTrue(self.second.fallback)
+
+        # It is not read again until the leader publishes a new one
+        version = self.second._version
+        self.assertIsNotNone(version)
+        self.assertIsNone(self.second.fetch())
+
+        self.first.publish(services("blog"))
+        self.assertEqual([svc.name for svc in self.second.fetch()],
+                         ["blog"])
+
+    def test_snapshot_too_big(self):
+        self.first.publish(services("blog"))
+        self.second.fetch()
+
+        self.store.MAX_SIZE = 10
+        self.first.publish(services("blog", "shop"))
+
+        # The previous snapshot is not kept
+        self.assertIsNone(self.second.fetch())
+        self.assertTrue(self.second.fallback)
+        self.assertIsNone(self.second.fetch())
+        self.assertTrue(self.second.fallback)
+
+        # Not tried again until the services change
+        self.store.MAX_SIZE = None
+        self.first.publish(services("blog", "shop"))
+        self.assertIsNone(self.second.fetch())
+
+        self.first.publish(services("shop"))
+        self.assertEqual([svc.name for svc in self.second.fetch()],
+                         ["shop"])
+        self.assertFalse(self.second.fallback)
+
+    def test_publish_error(self):
+        self.first.publish(services("blog"))
+        self.second.fetch()
+
+        publish = self.store.publish
+
+        def refuse_snapshots(data):
+            if data != plimni.leader.PUBLISH_FAILED:
+                raise OSError("too big")
+            publish(data)
+
+        self.store.publish = refuse_snapshots
+        self.first.publish(services("blog", "shop"))
+
+        self.assertIsNone(self.second.fetch())
+        self.assertTrue(self.second.fallback)
+
+        # Tried again on the next run
+        self.store.publish = publish
+        self.first.publish(services("blog", "shop"))
+        self.assertEqual(len(self.second.fetch()), 2)
+        self.assertFalse(self.second.fallback)
+
+    def test_other_cluster(self):
+        other = Election(self.store, "other", 30, BRANCH, "example.org")
+        other.publish(services())
+
+        self.assertIsNone(self.second.fetch())
+
+    def test_handover(self):
+        self.assertTrue(self.first.is_leader())
+        self.first.publish(services("blog"))
+
+        with open(self.store._lock_file, "w") as file_:
+            file_.write("first {}".format(time.time() - 1))
+
+        self.assertTrue(self.second.is_leader())
+        self.assertFalse(self.first.is_leader())
+        self.assertFalse(self.first.leader)
+
+        # The new leader publishes even the same services
+        self.second.publish(services("blog"))
+        self.assertEqual(self.second._published,
+                         tuple(svc.fingerprint() for svc in services("blog")))
+
+    def test_store_error(self):
+        class BrokenStore(plimni.leader.Store):
+            def acquire(self, identity, ttl):
+                raise OSError("unreachable")
+
+            def fetch(self, version):
+                raise OSError("unreachable")
+
+        election = Election(BrokenStore(), "first", 30, BRANCH, DOMAIN)
+
+        # Every instance retrieves the services itself
+        self.assertTrue(election.is_leader())
+        self.assertIsNone(election.fetch())
+        self.assertTrue(election.fallback)
+
+
+if __name__ == "__main__":
+    unittest.main()
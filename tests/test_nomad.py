@@ -0,0 +1,180 @@
+import time
+import unittest
+
+import plimni.nomad
+from plimni.nomad import NomadClient
+
+from .fake_consul import FakeConsul
+
+EXPOSED = ["plimni.io/expose=true"]
+
+
+def backends(client: NomadClient, name: str) -> list:
+    with client._lock:
+        return NomadClient._backends(client._endpoints.get(name, []))
+
+
+class NomadClientTest(unittest.TestCase):
+    def setUp(self):
+        self.consul = FakeConsul()
+        self.addCleanup(self.consul.stop)
+
+        self.consul.set_service("blog", EXPOSED, [("10.0.0.1", 8080, True)])
+        self.consul.set_service("shop", EXPOSED, [("10.0.0.2", 8080, True)])
+        self.consul.set_service("consul", [], [("10.0.0.3", 8300, True)])
+
+    def client(self, **kwargs) -> NomadClient:
+        return plimni.nomad.get_client(port=self.consul.port, timeout=2,
+                                       **kwargs)
+
+    def names(self, client: NomadClient) -> list:
+        return sorted(svc.name for svc in client.get_services(
+            cluster_branch="master", cluster_domain="example.com",
+        ))
+
+    def test_polling(self):
+        client = self.client()
+
+        self.assertEqual(self.names(client), ["blog", "shop"])
+        self.assertNotIn(("GET", "/v1/catalog/service/consul"),
+                         self.consul.requests)
+
+    def test_settings(self):
+        self.assertEqual(NomadClient._settings([
+            "plimni.io/expose=true", "plimni.io/path=/search?q=a", "other",
+        ]), {
+            "plimni.io/expose": "true", "plimni.io/path": "/search?q=a",
+        })
+
+    def test_health(self):
+        self.consul.set_service("blog", EXPOSED, [
+            ("10.0.0.1", 8080, True), ("10.0.0.4", 8080, False),
+        ])
+        client = self.client(watch=True, health=True)
+        self.names(client)
+
+        self.assertEqual(backends(client, "blog"), [("10.0.0.1", 8080, 1)])
+
+        self.consul.set_service("blog", EXPOSED, [
+            ("10.0.0.1", 8080, True), ("10.0.0.4", 8080, True),
+        ])
+
+        self.assertTrue(client.wait_for_change(5))
+        self.assertEqual(backends(client, "blog"), [
+            ("10.0.0.1", 8080, 1), ("10.0.0.4", 8080, 1),
+        ])
+
+    def test_service_address(self):
+        self.consul.set_service("blog", EXPOSED, [
+            ("10.0.0.1", 8080, True, "172.17.0.2"), ("10.0.0.4", 8080, True),
+        ])
+
+        for health in (False, True):
+            client = self.client(watch=True, health=health)
+            self.names(client)
+
+            # The address of the node is only used when the service has none
+            self.assertEqual(
+                [backend[:2] for backend in backends(client, "blog")],
+                [("172.17.0.2", 8080), ("10.0.0.4", 8080)],
+            )
+
+    def test_watch_refetches_moved_services_only(self):
+        for i in range(20):
+            self.consul.set_service("svc-{}".format(i), EXPOSED,
+                                    [("10.0.1.{}".format(i), 80, True)])
+
+        for health in (False, True):
+            client = self.client(watch=True, health=health)
+            self.names(client)
+            self.assertFalse(client.wait_for_change(0))
+
+            sent = len(self.consul.requests)
+            self.consul.set_service("blog", EXPOSED, [
+                ("10.0.0.{}".format(5 + health), 8080, True),
+            ])
+
+            self.assertTrue(client.wait_for_change(5))
+            self.assertEqual(
+                [backend[:2] for backend in backends(client, "blog")],
+                [("10.0.0.{}".format(5 + health), 8080)],
+            )
+
+            # Only the endpoints of blog were fetched again
+            time.sleep(self.consul.max_wait)
+            fetched = {
+                path.rpartition("/")[2]
+                for _, path in self.consul.requests[sent:]
+                if path.startswith(("/v1/catalog/service/",
+                                    "/v1/health/service/"))
+            }
+            self.assertEqual(fetched, {"blog"})
+
+    def test_watch_unchecked_service(self):
+        self.consul.set_service("blog", EXPOSED, [("10.0.0.1", 8080, True)],
+                                checks=False)
+        client = self.client(watch=True)
+        self.names(client)
+
+        # Without checks, blog can only be told changed by fetching it
+        self.consul.set_service("blog", EXPOSED, [("10.0.0.5", 8080, True)],
+                                checks=False)
+
+        self.assertTrue(client.wait_for_change(5))
+        self.assertEqual(backends(client, "blog"), [("10.0.0.5", 8080)])
+
+        sent = len(self.consul.requests)
+        self.consul.set_service("consul", [], [("10.0.0.7", 8300, True)])
+        time.sleep(self.consul.max_wait * 2)
+
+        self.assertIn(("GET", "/v1/catalog/service/blog"),
+                      self.consul.requests[sent:])
+        self.assertNotIn(("GET", "/v1/catalog/service/shop"),
+                         self.consul.requests[sent:])
+
+    def test_watch_bounded_queries(self):
+        for i in range(50):
+            self.consul.set_service("svc-{}".format(i), EXPOSED,
+                                    [("10.0.1.{}".format(i), 80, True)])
+
+        client = self.client(watch=True, concurrency=4)
+        self.assertEqual(len(self.names(client)), 52)
+
+        # Blocking queries are only sent on the catalog
+        time.sleep(self.consul.max_wait * 2)
+        blocking = [path for _, path in self.consul.requests
+                    if path.startswith("/v1/catalog/service/")]
+        self.assertEqual(len(blocking), 52)
+
+    def test_watch_index_reset(self):
+        client = self.client(watch=True)
+        self.names(client)
+
+        # Consul documents that an index going backwards resets the query
+        self.assertEqual(NomadClient._next_index("10", "3"), "0")
+        self.assertEqual(NomadClient._next_index("3", "10"), "10")
+
+        self.consul.set_index(1)
+        time.sleep(self.consul.max_wait * 2)
+        self.consul.set_service("shop", EXPOSED, [("10.0.0.6", 8080, True)],
+                                index=2)
+
+        self.assertTrue(client.wait_for_change(5))
+        self.assertEqual(backends(client, "shop"), [("10.0.0.6", 8080)])
+
+    def test_watch_retagged_service(self):
+        client = self.client(watch=True)
+        self.names(client)
+
+        self.consul.set_service("blog", [], [("10.0.0.1", 8080, True)])
+        self.assertTrue(client.wait_for_change(5))
+        self.assertEqual(self.names(client), ["shop"])
+
+        self.consul.set_service("blog", EXPOSED, [("10.0.0.1", 8080, True)])
+        self.assertTrue(client.wait_for_change(5))
+        self.assertEqual(self.names(client), ["blog", "shop"])
+        self.assertEqual(backends(client, "blog"), [("10.0.0.1", 8080)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+
+from plimni.scheduler import ReloadScheduler
+
+
+class FakeClock():
+    """A clock only moving when told to."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+class ReloadSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = ReloadScheduler(debounce=2, min_interval=10,
+                                         max_delay=30, clock=self.clock)
+
+    def test_nothing_pending(self):
+        self.assertFalse(self.scheduler.pending)
+        self.assertFalse(self.scheduler.is_due())
+        self.assertIsNone(self.scheduler.due_in())
+
+    def test_debounce(self):
+        self.scheduler.request()
+        self.assertEqual(self.scheduler.due_in(), 2)
+
+        # Each new request pushes the reload back
+        self.clock.advance(1.5)
+        self.scheduler.request()
+        self.clock.advance(1.5)
+        self.scheduler.request()
+        self.assertFalse(self.scheduler.is_due())
+        self.assertEqual(self.scheduler.due_in(), 2)
+
+        self.clock.advance(2)
+        self.assertTrue(self.scheduler.is_due())
+        self.assertEqual(self.scheduler.avoided, 2)
+
+        self.scheduler.reloaded()
+        self.assertFalse(self.scheduler.pending)
+        self.assertFalse(self.scheduler.is_due())
+
+    def test_min_interval(self):
+        self.scheduler.request()
+        self.clock.advance(2)
+        self.scheduler.reloaded()
+
+        self.clock.advance(1)
+        self.scheduler.request()
+        self.clock.advance(2)
+
+        # Debounced, but the previous reload was 3 seconds ago
+        self.assertFalse(self.scheduler.is_due())
+        self.assertEqual(self.scheduler.due_in(), 7)
+
+        self.clock.advance(7)
+        self.assertTrue(self.scheduler.is_due())
+
+    def test_max_delay(self):
+        self.scheduler.request()
+
+        # Changes keep coming, more often than the debounce time
+        for _ in range(29):
+            self.clock.advance(1)
+            self.scheduler.request()
+            self.assertFalse(self.scheduler.is_due())
+
+        self.clock.advance(1)
+        self.assertTrue(self.scheduler.is_due())
+        self.assertEqual(self.scheduler.due_in(), 0)
+        self.assertEqual(self.scheduler.avoided, 29)
+
+    def test_max_delay_over_min_interval(self):
+        scheduler = ReloadScheduler(debounce=2, min_interval=60,
+                                    max_delay=30, clock=self.clock)
+        scheduler.request()
+        scheduler.reloaded()
+
+        scheduler.request()
+        self.assertEqual(scheduler.due_in(), 30)
+
+    def test_avoided(self):
+        for _ in range(3):
+            self.scheduler.request()
+        self.clock.advance(2)
+        self.scheduler.reloaded()
+
+        # A request after a reload starts a new one
+        self.scheduler.request()
+        self.assertEqual(self.scheduler.avoided, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
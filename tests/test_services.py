@@ -0,0 +1,91 @@
+import unittest
+
+from plimni.services import build_service
+from plimni.tags import Tags
+
+
+def build(**settings):
+    return build_service(
+        name="blog",
+        settings=dict({Tags.EXPOSE: "true"}, **settings),
+        backends=[("10.0.0.1", 8080)],
+        cluster_branch="master",
+        cluster_domain="example.com",
+    )
+
+
+class ServiceBackendTest(unittest.TestCase):
+    def test_defaults(self):
+        svc = build()
+
+        self.assertEqual(svc.balance, "leastconn")
+        self.assertEqual(svc.http_reuse, "")
+        self.assertEqual(svc.timeout_connect, "10s")
+        self.assertEqual(svc.timeout_server, "10s")
+        self.assertEqual(svc.check_inter, "1000")
+        self.assertEqual((svc.check_fall, svc.check_rise), (3, 1))
+
+    def test_balance(self):
+        self.assertEqual(build(**{Tags.BALANCE: "roundrobin"}).balance,
+                         "roundrobin")
+
+        with self.assertRaises(ValueError):
+            build(**{Tags.BALANCE: "fastest"})
+
+    def test_http_reuse(self):
+        self.assertEqual(build(**{Tags.HTTP_REUSE: "safe"}).http_reuse,
+                         "safe")
+
+        with self.assertRaises(ValueError):
+            build(**{Tags.HTTP_REUSE: "sometimes"})
+
+    def test_durations(self):
+        for tag in (Tags.TIMEOUT_CONNECT, Tags.TIMEOUT_SERVER,
+                    Tags.TIMEOUT_QUEUE, Tags.SLOWSTART, Tags.CHECK_INTER):
+            for value in ("500", "500ms", "30s", "2m", "1h", "1d", "10us"):
+                build(**{tag: value})
+
+            for value in ("fast", "1.5s", "-1s", "10 s", "5w"):
+                with self.assertRaises(ValueError, msg=(tag, value)):
+                    build(**{tag: value})
+
+    def test_check(self):
+        svc = build(**{Tags.CHECK_INTER: "2s", Tags.CHECK_FALL: "2",
+                       Tags.CHECK_RISE: "5"})
+
+        self.assertEqual(svc.check_inter, "2s")
+        self.assertEqual((svc.check_fall, svc.check_rise), (2, 5))
+
+        for tag in (Tags.CHECK_FALL, Tags.CHECK_RISE):
+            for value in ("0", "-1", "two"):
+                with self.assertRaises(ValueError, msg=(tag, value)):
+                    build(**{tag: value})
+
+    def test_maxconn(self):
+        self.assertEqual(build(**{Tags.MAXCONN: "100"}).maxconn, 100)
+
+        for value in ("-1", "many"):
+            with self.assertRaises(ValueError):
+                build(**{Tags.MAXCONN: value})
+
+
+class ServiceCacheTest(unittest.TestCase):
+    def test_cache(self):
+        svc = build(**{Tags.CACHE_SIZE: "4095",
+                       Tags.CACHE_MAX_OBJECT_SIZE: "1048576"})
+
+        self.assertEqual(svc.cache_size, 4095)
+        self.assertEqual(svc.cache_max_object_size, 1048576)
+
+    def test_cache_too_big(self):
+        with self.assertRaises(ValueError):
+            build(**{Tags.CACHE_SIZE: "4096"})
+
+    def test_cache_object_too_big(self):
+        with self.assertRaises(ValueError):
+            build(**{Tags.CACHE_SIZE: "1",
+                     Tags.CACHE_MAX_OBJECT_SIZE: "1048576"})
+
+
+if __name__ == "__main__":
+    unittest.main()